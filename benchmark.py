@@ -0,0 +1,773 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import logging
+import itertools
+import contextlib
+import random
+import resource
+import tempfile
+import tracemalloc
+import collections
+from datetime import datetime, timedelta, timezone
+
+# index.py читает настройки из окружения при импорте, для бенчмарков реальный аккаунт не нужен
+os.environ.setdefault('API_ID', '1')
+os.environ.setdefault('API_HASH', 'benchmark')
+
+import index  # noqa: E402
+from telethon import types  # noqa: E402
+from telethon.errors import FloodWaitError  # noqa: E402
+
+BENCHMARK_CHAT_ID = -1
+
+
+def report(name, count, elapsed):
+    rate = count / elapsed if elapsed else float('inf')
+    print(f"{name:<40} {count:>10} за {elapsed:8.3f} с  ({rate:,.0f} в секунду)")
+
+
+# --- MongoDB: пакетная запись против записи по одному сообщению ---
+
+def make_records(count, start_id=1):
+    date = datetime(2025, 1, 1, 12, 0, tzinfo=timezone.utc)
+    return [
+        index.MessageRecord(message_id, date, sender_id=1000 + message_id % 50, text=f"Сообщение {message_id}")
+        for message_id in range(start_id, start_id + count)
+    ]
+
+
+# Прежний путь сохранения: find_one + insert_one на каждое сообщение
+async def legacy_save_messages(provider, messages, chat_id):
+    for record in messages:
+        existing_message = await provider.messages_collection.find_one({'chat_id': chat_id, 'id': record.id})
+        if not existing_message:
+            await provider.messages_collection.insert_one(record.to_document(chat_id))
+
+
+def make_motor_client(uri):
+    if uri:
+        return index.AsyncIOMotorClient(uri)
+    from mongomock_motor import AsyncMongoMockClient
+    return AsyncMongoMockClient()
+
+
+async def bench_mongo(args):
+    provider = index.MongoDBProvider(
+        args.uri,
+        batch_size=args.batch_size,
+        write_concern=args.write_concern,
+        motor_client=make_motor_client(args.uri)
+    )
+    await provider.ensure_indexes()
+    messages = make_records(args.count)
+
+    # Пишем в отдельный chat_id и чистим за собой, чтобы не задеть реальные данные
+    await provider.messages_collection.delete_many({'chat_id': BENCHMARK_CHAT_ID})
+    started = time.perf_counter()
+    await legacy_save_messages(provider, messages, BENCHMARK_CHAT_ID)
+    report("find_one + insert_one (новые)", len(messages), time.perf_counter() - started)
+    started = time.perf_counter()
+    await legacy_save_messages(provider, messages, BENCHMARK_CHAT_ID)
+    report("find_one + insert_one (дубликаты)", len(messages), time.perf_counter() - started)
+
+    await provider.messages_collection.delete_many({'chat_id': BENCHMARK_CHAT_ID})
+    started = time.perf_counter()
+    inserted, _ = await provider.save_messages(messages, BENCHMARK_CHAT_ID)
+    report(f"bulk_write (новые, добавлено {inserted})", len(messages), time.perf_counter() - started)
+    started = time.perf_counter()
+    _, duplicates = await provider.save_messages(messages, BENCHMARK_CHAT_ID)
+    report(f"bulk_write (дубликаты {duplicates})", len(messages), time.perf_counter() - started)
+
+    await provider.messages_collection.delete_many({'chat_id': BENCHMARK_CHAT_ID})
+
+
+# --- Фильтры: скомпилированный MessageFilter против прежних функций ---
+
+# Прежняя реализация фильтров, оставлена только для сравнения
+def legacy_should_download_media(message, filters):
+    if not message.media:
+        return False
+
+    if filters["filter_hashtags"] and message.text:
+        if not any(hashtag in message.text for hashtag in filters["filter_hashtags"]):
+            return False
+
+    if filters["filter_keywords"] and message.text:
+        if not any(keyword.lower() in message.text.lower() for keyword in filters["filter_keywords"]):
+            return False
+
+    if not filters["filter_message_types"]:
+        return filters["filter_max_file_size"] == 0 or message.media.document.size <= filters["filter_max_file_size"] if isinstance(message.media, types.MessageMediaDocument) else True
+
+    if "photo" in filters["filter_message_types"] and isinstance(message.media, types.MessageMediaPhoto):
+        if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
+            return False
+        return True
+
+    if "video" in filters["filter_message_types"] and isinstance(message.media, types.MessageMediaDocument) and message.media.document.mime_type.startswith('video'):
+        if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
+            return False
+        return filters["filter_max_file_size"] == 0 or message.media.document.size <= filters["filter_max_file_size"]
+
+    if "document" in filters["filter_message_types"] and isinstance(message.media, types.MessageMediaDocument) and not message.media.document.mime_type.startswith('video'):
+        if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
+            return False
+        return filters["filter_max_file_size"] == 0 or message.media.document.size <= filters["filter_max_file_size"]
+
+    if isinstance(message.media, types.MessageMediaPhoto):
+        for ext in filters["filter_message_types"]:
+            if ext in ["jpg", "jpeg", "png", "gif"] and ext in message.media.photo.mime_type.lower():
+                if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
+                    return False
+                return True
+    elif isinstance(message.media, types.MessageMediaDocument):
+        for ext in filters["filter_message_types"]:
+            if message.media.document.mime_type.startswith('video') and ext in ["mp4", "mov", "avi"]:
+                if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
+                    return False
+                return filters["filter_max_file_size"] == 0 or message.media.document.size <= filters["filter_max_file_size"]
+            if not message.media.document.mime_type.startswith('video') and ext in ["pdf", "doc", "docx", "txt"]:
+                if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
+                    return False
+                return filters["filter_max_file_size"] == 0 or message.media.document.size <= filters["filter_max_file_size"]
+
+    return False
+
+
+def legacy_should_process_message(message, filters):
+    if not filters["filter_message_types"]:
+        return True
+
+    # Логируем дату сообщения
+    print(f"Дата сообщения (message.date, UTC): {message.date}")
+    # Преобразуем дату сообщения в местное время (Europe/Moscow) для удобства
+    local_tz = index.pytz.timezone('Europe/Moscow')  # Можно заменить на local_tz из load_filters
+    message_date_local = message.date.astimezone(local_tz)
+    print(f"Дата сообщения (местное время, {local_tz}): {message_date_local}")
+
+    if filters["filter_date_from"]:
+        message_date = message.date.replace(microsecond=0)
+        filter_date_from = filters["filter_date_from"].replace(microsecond=0)
+        print(f"Сравнение с filter_date_from: message_date={message_date}, filter_date_from={filter_date_from}")
+        if message_date < filter_date_from:
+            print(f"Сообщение отфильтровано: дата {message_date} раньше filter_date_from {filter_date_from}")
+            return False
+
+    if filters["filter_date_to"]:
+        message_date = message.date.replace(microsecond=0)
+        filter_date_to = filters["filter_date_to"].replace(microsecond=0)
+        print(f"Сравнение с filter_date_to: message_date={message_date}, filter_date_to={filter_date_to}")
+        if message_date > filter_date_to:
+            print(f"Сообщение отфильтровано: дата {message_date} позже filter_date_to {filter_date_to}")
+            return False
+
+    if filters["filter_sender_ids"] and message.sender_id not in filters["filter_sender_ids"]:
+        print(f"Сообщение отфильтровано: sender_id {message.sender_id} не в filter_sender_ids")
+        return False
+
+    if filters["filter_hashtags"] and message.text:
+        if not any(hashtag in message.text for hashtag in filters["filter_hashtags"]):
+            print(f"Сообщение отфильтровано: нет хэштегов {filters['filter_hashtags']} в тексте")
+            return False
+
+    if filters["filter_keywords"] and message.text:
+        if not any(keyword.lower() in message.text.lower() for keyword in filters["filter_keywords"]):
+            print(f"Сообщение отфильтровано: нет ключевых слов {filters['filter_keywords']} в тексте")
+            return False
+
+    if "text" in filters["filter_message_types"] and message.text:
+        return True
+
+    if "photo" in filters["filter_message_types"] and isinstance(message.media, types.MessageMediaPhoto):
+        if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
+            print("Сообщение отфильтровано: фото без текста, но есть фильтры по хэштегам или ключевым словам")
+            return False
+        return True
+
+    if "video" in filters["filter_message_types"] and isinstance(message.media, types.MessageMediaDocument) and message.media.document.mime_type.startswith('video'):
+        if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
+            print("Сообщение отфильтровано: видео без текста, но есть фильтры по хэштегам или ключевым словам")
+            return False
+        return True
+
+    if "document" in filters["filter_message_types"] and isinstance(message.media, types.MessageMediaDocument) and not message.media.document.mime_type.startswith('video'):
+        if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
+            print("Сообщение отфильтровано: документ без текста, но есть фильтры по хэштегам или ключевым словам")
+            return False
+        return True
+
+    if message.media:
+        if isinstance(message.media, types.MessageMediaPhoto):
+            for ext in filters["filter_message_types"]:
+                if ext in ["jpg", "jpeg", "png", "gif"] and ext in message.media.photo.mime_type.lower():
+                    if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
+                        print("Сообщение отфильтровано: фото без текста, но есть фильтры по хэштегам или ключевым словам")
+                        return False
+                    return True
+        elif isinstance(message.media, types.MessageMediaDocument):
+            for ext in filters["filter_message_types"]:
+                if message.media.document.mime_type.startswith('video') and ext in ["mp4", "mov", "avi"]:
+                    if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
+                        print("Сообщение отфильтровано: видео без текста, но есть фильтры по хэштегам или ключевым словам")
+                        return False
+                    return True
+                if not message.media.document.mime_type.startswith('video') and ext in ["pdf", "doc", "docx", "txt"]:
+                    if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
+                        print("Сообщение отфильтровано: документ без текста, но есть фильтры по хэштегам или ключевым словам")
+                        return False
+                    return True
+
+    return False
+
+
+# Лёгкая замена telethon Message: фильтрам нужны только эти поля
+class SyntheticMessage:
+    __slots__ = ('id', 'date', 'sender_id', 'text', 'media', 'reply_to', 'views', 'forwards', 'edit_date',
+                 'grouped_id', 'entities')
+
+    def __init__(self, id, date, sender_id, text, media):
+        self.id = id
+        self.date = date
+        self.sender_id = sender_id
+        self.text = text
+        self.media = media
+        self.reply_to = None
+        self.views = None
+        self.forwards = None
+        self.edit_date = None
+        self.grouped_id = None
+        self.entities = None
+
+
+BENCHMARK_KEYWORDS = ['покупка', 'рост', 'падение', 'листинг', 'bitcoin', 'ethereum', 'solana', 'pump', 'dump', 'шорт', 'лонг']
+BENCHMARK_HASHTAGS = ['#BTC', '#ETH', '#SOL', '#signal']
+
+
+def make_document(size, mime_type):
+    return types.MessageMediaDocument(document=types.Document(
+        id=random.getrandbits(62), access_hash=0, file_reference=b'', date=None,
+        mime_type=mime_type, size=size, dc_id=2, attributes=[]
+    ))
+
+
+def make_synthetic_stream(count, pool_size=5000, seed=1):
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    words = ['рынок', 'цена', 'новости', 'сегодня', 'биржа', 'объем', 'график', 'уровень', 'сделка', 'канал']
+    pool = []
+    for message_id in range(1, pool_size + 1):
+        text_words = rng.choices(words, k=rng.randint(5, 40))
+        if rng.random() < 0.3:
+            text_words.append(rng.choice(BENCHMARK_KEYWORDS).upper())
+        if rng.random() < 0.2:
+            text_words.append(rng.choice(BENCHMARK_HASHTAGS))
+        text = ' '.join(text_words) if rng.random() < 0.85 else ''
+        roll = rng.random()
+        if roll < 0.6:
+            media = None
+        elif roll < 0.8:
+            media = types.MessageMediaPhoto()
+        elif roll < 0.9:
+            media = make_document(rng.randint(1, 50) * 1024 * 1024, 'video/mp4')
+        else:
+            media = make_document(rng.randint(1, 20) * 1024 * 1024, 'application/pdf')
+        date = start + timedelta(minutes=rng.randint(0, 60 * 24 * 120))
+        pool.append(SyntheticMessage(message_id, date, rng.randint(1, 200), text, media))
+    return list(itertools.islice(itertools.cycle(pool), count))
+
+
+def make_benchmark_filters():
+    return {
+        "filter_message_types": ["text", "photo", "video", "pdf"],
+        "filter_keywords": BENCHMARK_KEYWORDS,
+        "filter_hashtags": BENCHMARK_HASHTAGS,
+        "filter_date_from": datetime(2025, 1, 15, tzinfo=timezone.utc),
+        "filter_date_to": datetime(2025, 4, 1, tzinfo=timezone.utc),
+        "filter_sender_ids": list(range(1, 150)),
+        "filter_max_file_size": 10 * 1024 * 1024,
+        "chats": []
+    }
+
+
+def run_filters(stream, should_process, should_download):
+    processed = downloaded = 0
+    started = time.perf_counter()
+    for message in stream:
+        if should_process(message):
+            processed += 1
+            if should_download(message):
+                downloaded += 1
+    return processed, downloaded, time.perf_counter() - started
+
+
+async def bench_filters(args):
+    filters = make_benchmark_filters()
+    stream = make_synthetic_stream(args.count)
+
+    # Прежний код печатал каждое сравнение дат, вывод отправляем в /dev/null, чтобы мерить только CPU
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        legacy = run_filters(
+            stream,
+            lambda message: legacy_should_process_message(message, filters),
+            lambda message: legacy_should_download_media(message, filters)
+        )
+    report(f"прежние функции (прошло {legacy[0]}, медиа {legacy[1]})", len(stream), legacy[2])
+
+    message_filter = index.MessageFilter(filters)
+    compiled = run_filters(stream, message_filter.should_process, message_filter.should_download)
+    report(f"MessageFilter (прошло {compiled[0]}, медиа {compiled[1]})", len(stream), compiled[2])
+
+    if legacy[:2] != compiled[:2]:
+        print("ВНИМАНИЕ: результаты фильтрации различаются")
+        return 1
+    print(f"Ускорение: {legacy[2] / compiled[2]:.1f}x")
+
+
+# --- Выходные приемники: Kafka с пачками и ограничением неподтвержденных сообщений ---
+
+# Брокер в памяти: каждый produce-запрос стоит один сетевой round-trip
+class FakeBroker:
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = 0
+        self.messages = 0
+
+    async def produce(self, batch):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        self.messages += len(batch)
+
+
+# Минимальный аналог AIOKafkaProducer: копит сообщения до linger_ms или max_batch_size байт
+class FakeKafkaProducer:
+    def __init__(self, broker, linger_ms=index.kafka_linger_ms, max_batch_size=index.kafka_max_batch_bytes):
+        self.broker = broker
+        self.linger = linger_ms / 1000
+        self.max_batch_size = max_batch_size
+        self._batch = []
+        self._batch_bytes = 0
+        self._linger_task = None
+        self._requests = set()
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        await self.flush()
+
+    async def send(self, topic, value=None, key=None):
+        delivery = asyncio.get_running_loop().create_future()
+        self._batch.append((value, delivery))
+        self._batch_bytes += len(value)
+        if self._batch_bytes >= self.max_batch_size:
+            self._send_batch()
+        elif self._linger_task is None:
+            self._linger_task = asyncio.create_task(self._linger())
+        return delivery
+
+    async def _linger(self):
+        await asyncio.sleep(self.linger)
+        self._linger_task = None
+        self._send_batch()
+
+    def _send_batch(self):
+        if not self._batch:
+            return
+        batch, self._batch, self._batch_bytes = self._batch, [], 0
+        request = asyncio.create_task(self._produce(batch))
+        self._requests.add(request)
+        request.add_done_callback(self._requests.discard)
+
+    async def _produce(self, batch):
+        await self.broker.produce(batch)
+        for _, delivery in batch:
+            delivery.set_result(None)
+
+    async def flush(self):
+        if self._linger_task:
+            self._linger_task.cancel()
+            self._linger_task = None
+        self._send_batch()
+        if self._requests:
+            await asyncio.gather(*list(self._requests))
+
+
+async def run_write_batches(provider, sink, batches):
+    # Как в fetch_chat_messages: с приемником чекпоинт (и ожидание подтверждений) раз в OUTPUT_CHECKPOINT_INTERVAL
+    started = time.perf_counter()
+    unconfirmed = 0
+    for number, records in enumerate(batches, 1):
+        unconfirmed += len(records)
+        checkpoint = not sink or unconfirmed >= index.output_checkpoint_interval or number == len(batches)
+        if checkpoint:
+            unconfirmed = 0
+        await index.write_batch(provider, sink, BENCHMARK_CHAT_ID, records,
+                                min_id=records[0].id if checkpoint else None,
+                                max_id=records[-1].id if checkpoint else None)
+    return time.perf_counter() - started
+
+
+async def bench_sink(args):
+    messages = make_records(args.count)
+    batches = [messages[start:start + args.batch_size] for start in range(0, len(messages), args.batch_size)]
+
+    # Прежний способ без пачек: одно сообщение — один запрос с ожиданием подтверждения
+    broker = FakeBroker(args.latency / 1000)
+    started = time.perf_counter()
+    for record in messages:
+        await broker.produce([index.record_to_event(BENCHMARK_CHAT_ID, record)])
+    report(f"по одному сообщению ({broker.requests} запросов)", len(messages), time.perf_counter() - started)
+
+    for sinks in (['mongodb'], ['kafka'], ['mongodb', 'kafka']):
+        index.store_messages = 'mongodb' in sinks
+        provider = index.MemoryStorageProvider()
+        broker = FakeBroker(args.latency / 1000)
+        sink = None
+        if 'kafka' in sinks:
+            sink = index.KafkaSink(FakeKafkaProducer(broker), max_in_flight=args.max_in_flight)
+            await sink.start()
+        elapsed = await run_write_batches(provider, sink, batches)
+        if sink:
+            await sink.close()
+        report(f"{'+'.join(sinks)} ({broker.requests} запросов к брокеру)", len(messages), elapsed)
+        if sink and broker.messages != len(messages):
+            print(f"ВНИМАНИЕ: брокер получил {broker.messages} из {len(messages)} сообщений")
+            return 1
+
+
+# --- Логирование: print на каждое сообщение против уровневого логгера со сводкой по чату ---
+
+# Прежний горячий цикл fetch_chat_messages: строка в stdout на каждое сообщение
+def run_print_logging(stream, message_filter):
+    accepted = 0
+    started = time.perf_counter()
+    for message in stream:
+        if not message_filter.should_process(message):
+            print(f"Сообщение {message.id} отфильтровано: date={message.date}, text={message.text}")
+            continue
+        record = index.MessageRecord.from_message(message)
+        print(f"Сообщение прошло фильтр: {record.id}|{record.date}|{record.sender_id}|{record.text}")
+        accepted += 1
+    return accepted, time.perf_counter() - started
+
+
+# Тот же цикл, что и в fetch_chat_messages сейчас: DEBUG-строки под проверкой уровня и сводка ChatLogSummary
+def run_leveled_logging(stream, message_filter):
+    media_jobs = []
+    summary = index.ChatLogSummary(BENCHMARK_CHAT_ID, 'forward')
+    started = time.perf_counter()
+    for message in stream:
+        if not message_filter.should_process(message):
+            summary.filtered += 1
+            if index.logger.isEnabledFor(logging.DEBUG):
+                index.logger.debug("Сообщение %s отфильтровано: date=%s, text=%s", message.id, message.date, message.text)
+        else:
+            index.build_message_record(message, message_filter, media_jobs)
+            summary.accepted += 1
+        summary.tick()
+    summary.log()
+    return summary.accepted, time.perf_counter() - started
+
+
+async def bench_logging(args):
+    index.download_media_enabled = False
+    stream = make_synthetic_stream(args.count)
+    message_filter = index.MessageFilter(make_benchmark_filters())
+
+    # Весь вывод уходит в /dev/null, поэтому меряется стоимость форматирования и вызовов, а не терминала
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            accepted, elapsed = run_print_logging(stream, message_filter)
+        report(f"print на каждое сообщение (прошло {accepted})", len(stream), elapsed)
+        baseline = elapsed
+
+        for level, fmt in (('INFO', 'text'), ('INFO', 'json'), ('DEBUG', 'text'), ('DEBUG', 'json')):
+            index.setup_logging(level, fmt, devnull)
+            accepted, elapsed = run_leveled_logging(stream, message_filter)
+            report(f"logger {level}/{fmt} (прошло {accepted})", len(stream), elapsed)
+            if level == 'INFO' and fmt == 'text':
+                print(f"Ускорение при выключенном DEBUG: {baseline / elapsed:.1f}x")
+
+
+# --- Replay: весь конвейер main() на фейковом TelegramClient без живого аккаунта ---
+
+class ReplayFile:
+    __slots__ = ('size', 'name', 'ext', 'mime_type')
+
+    def __init__(self, size, name, mime_type):
+        self.size = size
+        self.name = name
+        self.ext = os.path.splitext(name)[1] if name else ''
+        self.mime_type = mime_type
+
+
+class ReplayMessage:
+    def __init__(self, client, chat_id, id, date, sender_id, text, media=None, file=None, grouped_id=None):
+        self.client = client
+        self.chat_id = chat_id
+        self.id = id
+        self.date = date
+        self.sender_id = sender_id
+        self.text = text
+        self.media = media
+        self.file = file
+        self.grouped_id = grouped_id
+        self.reply_to = None
+        self.views = None
+        self.forwards = None
+        self.edit_date = None
+        self.entities = None
+
+    async def download_media(self, file=None):
+        return await self.client.download_media(self, file=file)
+
+
+class ReplaySession:
+    dc_id = 2
+
+
+class ReplayDialog:
+    def __init__(self, chat_id, message):
+        self.id = chat_id
+        self.title = f"Чат {chat_id}"
+        self.message = message
+        self.date = message.date if message else None
+        self.pinned = False
+
+
+# Фейковый клиент: те же вызовы, что делает index.py, с задержкой на каждый запрос и случайными FloodWait
+class FakeTelegramClient:
+    def __init__(self, latency=0.0, flood_rate=0.0, flood_seconds=0, page_size=100, seed=1):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.page_size = page_size
+        self.chats = {}
+        self.requests = collections.Counter()
+        self.flood_waits = 0
+        self.session = ReplaySession()
+        self._rng = random.Random(seed)
+
+    async def _request(self, name):
+        self.requests[name] += 1
+        if self.flood_rate and self._rng.random() < self.flood_rate:
+            self.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def is_user_authorized(self):
+        return True
+
+    async def get_entity(self, chat_id):
+        await self._request('GetEntity')
+        if chat_id not in self.chats:
+            raise ValueError(f"Чат {chat_id} не найден")
+        return types.Channel(id=chat_id, title=f"Чат {chat_id}", photo=types.ChatPhotoEmpty(), date=None)
+
+    async def iter_dialogs(self):
+        dialogs = sorted((ReplayDialog(chat_id, messages[-1] if messages else None)
+                          for chat_id, messages in self.chats.items()),
+                         key=lambda dialog: dialog.date or datetime.min.replace(tzinfo=timezone.utc), reverse=True)
+        for start in range(0, len(dialogs), self.page_size):
+            await self._request('GetDialogs')
+            for dialog in dialogs[start:start + self.page_size]:
+                yield dialog
+
+    async def iter_messages(self, chat_id, min_id=0, max_id=0, reverse=False, limit=None):
+        # Сообщения отсортированы по id, как в Telegram; страницы по page_size, один запрос на страницу
+        messages = [message for message in self.chats[chat_id]
+                    if message.id > (min_id or 0) and (not max_id or message.id < max_id)]
+        if not reverse:
+            messages.reverse()
+        if limit is not None:
+            messages = messages[:limit]
+        for start in range(0, len(messages), self.page_size):
+            await self._request('GetHistory')
+            for message in messages[start:start + self.page_size]:
+                yield message
+
+    async def get_messages(self, chat_id, ids=None):
+        await self._request('GetMessages')
+        by_id = {message.id: message for message in self.chats[chat_id]}
+        return [by_id.get(message_id) for message_id in ids]
+
+    async def download_media(self, message, file=None):
+        await self._request('GetFile')
+        # ID сообщений у всех синтетических чатов начинаются с 1, поэтому имя уникально только вместе с chat_id
+        path = os.path.join(file, f"{message.chat_id}_{message.id}_{message.file.name}")
+        with open(path, 'wb') as f:
+            f.write(replay_media_bytes(message.media, 0, message.file.size))
+        return path
+
+    async def iter_download(self, media, offset=0, limit=None, request_size=index.DOWNLOAD_CHUNK_SIZE, file_size=None):
+        for chunk_offset in range(offset, min(file_size, offset + limit * request_size), request_size):
+            await self._request('GetFile')
+            yield replay_media_bytes(media, chunk_offset, min(request_size, file_size - chunk_offset))
+
+
+# Содержимое файла строится из его id, поэтому одинаковые медиа совпадают по sha256, а разные — нет
+def replay_media_bytes(media, offset, size):
+    media_id = media.photo.id if isinstance(media, types.MessageMediaPhoto) else media.document.id
+    pattern = media_id.to_bytes(8, 'little')
+    start = offset % len(pattern)
+    return (pattern * ((start + size) // len(pattern) + 1))[start:start + size]
+
+
+def make_replay_media(rng, kind, media_id):
+    if kind == 'photo':
+        photo = types.Photo(id=media_id, access_hash=media_id, file_reference=b'', date=None, sizes=[], dc_id=2)
+        return types.MessageMediaPhoto(photo=photo), ReplayFile(64 * 1024, 'photo.jpg', 'image/jpeg')
+    name, mime_type = ('video.mp4', 'video/mp4') if kind == 'video' else ('report.pdf', 'application/pdf')
+    size = rng.randint(16, 256) * 1024
+    document = types.Document(
+        id=media_id, access_hash=media_id, file_reference=b'', date=None, mime_type=mime_type, size=size, dc_id=2,
+        attributes=[types.DocumentAttributeFilename(file_name=name)]
+    )
+    return types.MessageMediaDocument(document=document), ReplayFile(size, name, mime_type)
+
+
+# Синтетический чат: текст с ключевыми словами в части сообщений, альбомы и медиа.
+# Медиа берутся из ограниченного набора id, поэтому повторные пересылки проверяют дедупликацию
+def make_replay_chat(client, chat_id, count, album_ratio, media_ratio, media_pool, rng):
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    words = ['рынок', 'цена', 'новости', 'сегодня', 'биржа', 'объем', 'график', 'уровень', 'сделка', 'канал']
+    messages = []
+    message_id = 1
+    while message_id <= count:
+        date = start + timedelta(seconds=message_id * 30)
+        text_words = rng.choices(words, k=rng.randint(3, 30))
+        if rng.random() < 0.3:
+            text_words.append(rng.choice(BENCHMARK_KEYWORDS))
+        text = ' '.join(text_words)
+        roll = rng.random()
+        if roll < album_ratio:
+            grouped_id = chat_id * 1000000 + message_id
+            for part in range(min(rng.randint(2, index.ALBUM_MAX_SIZE), count - message_id + 1)):
+                media, file = make_replay_media(rng, 'photo', rng.randrange(media_pool))
+                messages.append(ReplayMessage(client, chat_id, message_id, date, rng.randint(1, 200),
+                                              text if part == 0 else '', media, file, grouped_id))
+                message_id += 1
+            continue
+        media = file = None
+        if roll < album_ratio + media_ratio:
+            media, file = make_replay_media(rng, rng.choice(['photo', 'video', 'pdf']), rng.randrange(media_pool))
+        messages.append(ReplayMessage(client, chat_id, message_id, date, rng.randint(1, 200), text, media, file))
+        message_id += 1
+    return messages
+
+
+async def bench_replay(args):
+    index.setup_logging(args.log_level)
+    rng = random.Random(args.seed)
+    client = FakeTelegramClient(args.latency / 1000, args.flood_rate, args.flood_seconds, seed=args.seed)
+    chat_ids = [-(1000000000000 + number) for number in range(args.chats)]
+    for chat_id in chat_ids:
+        client.chats[chat_id] = make_replay_chat(client, chat_id, args.messages, args.album_ratio, args.media_ratio,
+                                                 args.media_pool, rng)
+    total = sum(len(messages) for messages in client.chats.values())
+
+    if args.storage == 'memory':
+        provider = index.MemoryStorageProvider()
+    else:
+        provider = index.MongoDBProvider(args.uri, motor_client=make_motor_client(args.uri))
+    filters = {
+        "filter_message_types": ["text", "photo", "video", "pdf"],
+        "filter_keywords": BENCHMARK_KEYWORDS if args.keywords else [],
+        "filter_hashtags": [],
+        "filter_date_from": None,
+        "filter_date_to": None,
+        "filter_sender_ids": [],
+        "filter_max_file_size": 0,
+        "chats": [str(chat_id) for chat_id in chat_ids]
+    }
+
+    # main() берет клиент, хранилище и фильтры из модуля index, подменяем их на время прогона
+    index.client = client
+    index.create_storage_provider = lambda: provider
+    index.load_filters = lambda: filters
+    index.stream_mode = False
+    index.download_media_enabled = args.media
+
+    with tempfile.TemporaryDirectory() as media_path:
+        index.download_media_path = media_path
+        if args.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        await index.main()
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+        if args.trace_memory:
+            tracemalloc.stop()
+
+    seen = index.MESSAGES_SEEN.value()
+    report(f"replay: {args.chats} чатов, сохранено {index.MESSAGES_STORED.value()}", seen, elapsed)
+    print(f"Сообщений в чатах: {total}, просмотрено: {seen}")
+    if peak is not None:
+        print(f"Пик памяти Python (tracemalloc): {peak / 1048576:.1f} МБ")
+    print(f"Пик RSS процесса: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} МБ")
+    print("Запросы к Telegram: " + ", ".join(f"{name} {count}" for name, count in sorted(client.requests.items())))
+    print(f"FloodWait: {client.flood_waits}")
+    stages = {labels[0][1]: seconds for labels, seconds in index.STAGE_SECONDS.values.items()}
+    print("Время по стадиям: " + ", ".join(f"{stage} {seconds:.2f} с" for stage, seconds in sorted(stages.items())))
+
+    rate = seen / elapsed if elapsed else float('inf')
+    if args.min_rate and rate < args.min_rate:
+        print(f"РЕГРЕССИЯ: {rate:,.0f} сообщ./с меньше порога {args.min_rate:,.0f}")
+        return 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки парсера Telegram")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    mongo_parser = subparsers.add_parser('mongo', help="пакетная запись в MongoDB против записи по одному сообщению")
+    mongo_parser.add_argument('--uri', default=None, help="URI локального mongod, без него используется mongomock")
+    mongo_parser.add_argument('--count', type=int, default=2000)
+    mongo_parser.add_argument('--batch-size', type=int, default=index.mongodb_batch_size)
+    mongo_parser.add_argument('--write-concern', default=index.mongodb_write_concern)
+    mongo_parser.set_defaults(handler=bench_mongo)
+
+    filters_parser = subparsers.add_parser('filters', help="скомпилированный MessageFilter против прежних функций фильтрации")
+    filters_parser.add_argument('--count', type=int, default=1000000)
+    filters_parser.set_defaults(handler=bench_filters)
+
+    logging_parser = subparsers.add_parser('logging', help="print на каждое сообщение против уровневого логгера")
+    logging_parser.add_argument('--count', type=int, default=200000)
+    logging_parser.set_defaults(handler=bench_logging)
+
+    replay_parser = subparsers.add_parser('replay', help="весь конвейер main() на фейковом TelegramClient")
+    replay_parser.add_argument('--chats', type=int, default=20)
+    replay_parser.add_argument('--messages', type=int, default=5000, help="сообщений в каждом чате")
+    replay_parser.add_argument('--album-ratio', type=float, default=0.05)
+    replay_parser.add_argument('--media-ratio', type=float, default=0.2)
+    replay_parser.add_argument('--media-pool', type=int, default=2000, help="число уникальных медиафайлов")
+    replay_parser.add_argument('--media', action='store_true', help="скачивать медиа через MediaDownloader")
+    replay_parser.add_argument('--keywords', action='store_true', help="фильтровать по ключевым словам")
+    replay_parser.add_argument('--latency', type=float, default=5.0, help="задержка одного запроса к Telegram, мс")
+    replay_parser.add_argument('--flood-rate', type=float, default=0.001, help="доля запросов, отвечающих FloodWait")
+    replay_parser.add_argument('--flood-seconds', type=int, default=0)
+    replay_parser.add_argument('--storage', choices=['memory', 'mongo'], default='memory')
+    replay_parser.add_argument('--uri', default=None, help="URI локального mongod для --storage mongo, без него mongomock")
+    replay_parser.add_argument('--trace-memory', action='store_true', help="пик памяти через tracemalloc (медленнее)")
+    replay_parser.add_argument('--min-rate', type=float, default=0, help="порог сообщ./с, ниже которого код выхода 1")
+    replay_parser.add_argument('--log-level', default='WARNING')
+    replay_parser.add_argument('--seed', type=int, default=1)
+    replay_parser.set_defaults(handler=bench_replay)
+
+    sink_parser = subparsers.add_parser('sink', help="сквозная запись пачек в MongoDB/Kafka через фейковый брокер")
+    sink_parser.add_argument('--count', type=int, default=20000)
+    sink_parser.add_argument('--batch-size', type=int, default=50, help="пачка fetch_chat_messages")
+    sink_parser.add_argument('--latency', type=float, default=2.0, help="задержка одного запроса к брокеру, мс")
+    sink_parser.add_argument('--max-in-flight', type=int, default=index.kafka_max_in_flight)
+    sink_parser.set_defaults(handler=bench_sink)
+
+    args = parser.parse_args()
+    return asyncio.run(args.handler(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,36 @@
 import os
+import sys
+from abc import ABC, abstractmethod
 import json
+import logging
+import re
+import shutil
+import hashlib
+import mimetypes
 from datetime import datetime
+from collections import OrderedDict
 from dotenv import load_dotenv
 import asyncio
+import time
+import threading
+import cProfile
 from telethon import TelegramClient
 from telethon import types
+from telethon import events
+from telethon import utils
+from telethon.errors import FloodWaitError
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from pymongo.write_concern import WriteConcern
 import pytz
 from tzlocal import get_localzone
+from query import MessageQuery, ensure_query_indexes
+
+try:
+    from aiokafka import AIOKafkaProducer
+except ImportError:
+    AIOKafkaProducer = None
 
 load_dotenv()
 
@@ -19,55 +42,818 @@ session_name = os.getenv('SESSION_NAME')
 mongodb_uri = os.getenv('MONGODB_URI')
 download_media_enabled = os.getenv('DOWNLOAD_MEDIA_ENABLED', 'False').lower() in ['true', '1', 'yes']
 download_media_path = os.getenv('DOWNLOAD_MEDIA_PATH', './media')
+# Размер пачки выгрузки: столько сообщений пишется одним bulk_write, и после каждой пачки двигается чекпоинт
+mongodb_batch_size = int(os.getenv('MONGODB_BATCH_SIZE', '1000'))
+mongodb_write_concern = os.getenv('MONGODB_WRITE_CONCERN', '1')
+mongodb_max_pool_size = int(os.getenv('MONGODB_MAX_POOL_SIZE', '100'))
+mongodb_min_pool_size = int(os.getenv('MONGODB_MIN_POOL_SIZE', '0'))
+provider_type = os.getenv('PROVIDER_TYPE', 'mongodb')
+dialog_sync_ttl = int(os.getenv('DIALOG_SYNC_TTL', '600'))
+output_sinks = [sink.strip() for sink in os.getenv('OUTPUT_SINKS', 'mongodb').split(',') if sink.strip()]
+store_messages = 'mongodb' in output_sinks
+kafka_bootstrap_servers = os.getenv('KAFKA_BOOTSTRAP_SERVERS', 'localhost:9092')
+kafka_topic = os.getenv('KAFKA_TOPIC', 'raw_data')
+kafka_compression = os.getenv('KAFKA_COMPRESSION', 'gzip')
+kafka_linger_ms = int(os.getenv('KAFKA_LINGER_MS', '50'))
+kafka_max_batch_bytes = int(os.getenv('KAFKA_MAX_BATCH_BYTES', str(256 * 1024)))
+kafka_max_in_flight = int(os.getenv('KAFKA_MAX_IN_FLIGHT', '1000'))
+output_checkpoint_interval = int(os.getenv('OUTPUT_CHECKPOINT_INTERVAL', '1000'))
+log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
+log_format = os.getenv('LOG_FORMAT', 'text')
+log_summary_interval = float(os.getenv('LOG_SUMMARY_INTERVAL', '10'))
+metrics_port = int(os.getenv('METRICS_PORT', '0'))
+metrics_dump_path = os.getenv('METRICS_DUMP_PATH', '')
+profile_mode = os.getenv('PROFILE', '')
+profile_path = os.getenv('PROFILE_PATH', 'profiles')
+profile_interval = float(os.getenv('PROFILE_INTERVAL', '0.005'))
+shard_sessions = [session.strip() for session in os.getenv('SHARD_SESSIONS', '').split(',') if session.strip()]
+shard_worker_id = os.getenv('SHARD_WORKER_ID', '')
+shard_lease_ttl = int(os.getenv('SHARD_LEASE_TTL', '60'))
+shard_heartbeat_interval = int(os.getenv('SHARD_HEARTBEAT_INTERVAL', '10'))
+shard_flood_budget = int(os.getenv('SHARD_FLOOD_BUDGET', '0'))
+shard_run_started = float(os.getenv('SHARD_RUN_STARTED', '0'))
+shard_max_restarts = int(os.getenv('SHARD_MAX_RESTARTS', '3'))
+shard_primary = os.getenv('SHARD_PRIMARY', '')
+parser_concurrency = int(os.getenv('PARSER_CONCURRENCY', '8'))
+parser_per_dc_concurrency = int(os.getenv('PARSER_PER_DC_CONCURRENCY', '4'))
+parser_per_chat_concurrency = int(os.getenv('PARSER_PER_CHAT_CONCURRENCY', '1'))
+parser_max_retries = int(os.getenv('PARSER_MAX_RETRIES', '3'))
+media_workers = int(os.getenv('MEDIA_WORKERS', '4'))
+media_queue_size = int(os.getenv('MEDIA_QUEUE_SIZE', '100'))
+media_max_file_size = int(os.getenv('MEDIA_MAX_FILE_SIZE', '0'))
+media_retries = int(os.getenv('MEDIA_RETRIES', '3'))
+media_parallel_threshold = int(os.getenv('MEDIA_PARALLEL_THRESHOLD', str(20 * 1024 * 1024)))
+media_parallel_parts = int(os.getenv('MEDIA_PARALLEL_PARTS', '4'))
+stream_mode = os.getenv('STREAM_MODE', 'False').lower() in ['true', '1', 'yes']
+stream_batch_size = int(os.getenv('STREAM_BATCH_SIZE', '100'))
+stream_flush_interval = float(os.getenv('STREAM_FLUSH_INTERVAL', '1.0'))
+stream_gap_fill_interval = float(os.getenv('STREAM_GAP_FILL_INTERVAL', '300'))
+backfill_enabled = os.getenv('BACKFILL_ENABLED', 'False').lower() in ['true', '1', 'yes']
+media_store_enabled = os.getenv('MEDIA_STORE_ENABLED', 'True').lower() in ['true', '1', 'yes']
+media_store_max_bytes = int(os.getenv('MEDIA_STORE_MAX_BYTES', '0'))
 
 # Создаем папку для медиа, если она не существует
 if download_media_enabled and not os.path.exists(download_media_path):
     os.makedirs(download_media_path)
 
+# Логирование: уровень из LOG_LEVEL, формат text или json (одна JSON-строка на запись)
+logger = logging.getLogger('telegram_parser')
+
+# Поля, которые есть у любой LogRecord; все остальное пришло через extra и попадает в JSON
+LOG_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, pytz.UTC).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in LOG_RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging(level=log_level, fmt=log_format, stream=None):
+    handler = logging.StreamHandler(stream or sys.stdout)
+    if fmt == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logger.handlers[:] = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+# Метрики в формате Prometheus: счетчики и гистограммы с метками, без внешних зависимостей
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, format_labels(key), value
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def time(self, **labels):
+        return HistogramTimer(self, labels)
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', format_labels(key, [('le', bound)]), cumulative
+            yield f'{self.name}_bucket', format_labels(key, [('le', '+Inf')]), count
+            yield f'{self.name}_sum', format_labels(key), total
+            yield f'{self.name}_count', format_labels(key), count
+
+# Работает и вокруг await: with metric.time(): await ...
+class HistogramTimer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text):
+        metric = Counter(name, help_text)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+FETCH_CHAT_SECONDS = metrics.histogram('telegram_parser_fetch_chat_seconds', 'Время выгрузки одного чата')
+STAGE_SECONDS = metrics.counter('telegram_parser_stage_seconds_total',
+                                'Время по стадиям выгрузки: telegram, filter, store, media_queue')
+SAVE_MESSAGES_SECONDS = metrics.histogram('telegram_parser_save_messages_seconds', 'Время записи пачки в MongoDB')
+MEDIA_DOWNLOAD_SECONDS = metrics.histogram('telegram_parser_media_download_seconds', 'Время скачивания одного медиафайла')
+LOAD_ALL_CHATS_SECONDS = metrics.histogram('telegram_parser_load_all_chats_seconds', 'Время синхронизации диалогов')
+MESSAGES_SEEN = metrics.counter('telegram_parser_messages_seen_total', 'Просмотрено сообщений')
+MESSAGES_FILTERED = metrics.counter('telegram_parser_messages_filtered_total', 'Отфильтровано сообщений')
+MESSAGES_STORED = metrics.counter('telegram_parser_messages_stored_total', 'Сохранено новых сообщений')
+MESSAGES_DEDUPLICATED = metrics.counter('telegram_parser_messages_deduplicated_total',
+                                        'Сообщений, которые уже были в хранилище')
+MEDIA_RESULTS = metrics.counter('telegram_parser_media_total', 'Обработано медиа по результату')
+MEDIA_BYTES = metrics.counter('telegram_parser_media_bytes_total', 'Скачано байт медиа')
+FLOOD_WAITS = metrics.counter('telegram_parser_flood_waits_total', 'Число пауз из-за FloodWait')
+FLOOD_WAIT_SECONDS = metrics.counter('telegram_parser_flood_wait_seconds_total', 'Суммарная длительность пауз FloodWait')
+
+# Prometheus забирает метрики по HTTP: на любой запрос отдаем текущий render()
+async def start_metrics_server(port=metrics_port):
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = metrics.render().encode()
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, port=port)
+    logger.info("Метрики доступны на http://localhost:%s/metrics", port)
+    return server
+
+def dump_metrics(path=metrics_dump_path):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(metrics.render())
+    logger.info("Метрики записаны в %s", path)
+
+# Семплирующий профайлер: поток раз в interval снимает стек главного потока и считает одинаковые стеки.
+# Результат в формате collapsed stacks, из него строится flamegraph (flamegraph.pl, speedscope)
+class SamplingProfiler:
+    def __init__(self, interval=profile_interval):
+        self.interval = interval
+        self.stacks = {}
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def enable(self):
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def dump_stats(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write(f'{stack} {count}\n')
+
+def create_profiler(mode=profile_mode):
+    if not mode:
+        return None, None
+    os.makedirs(profile_path, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    if mode == 'cprofile':
+        return cProfile.Profile(), os.path.join(profile_path, f'profile-{stamp}.prof')
+    if mode == 'sample':
+        return SamplingProfiler(), os.path.join(profile_path, f'profile-{stamp}.collapsed')
+    raise ValueError(f"Неизвестный режим PROFILE: {mode}")
+
 client = TelegramClient(session_name, api_id, api_hash)
 
+# Запись сообщения для хранилища, собирается напрямую из telethon Message без промежуточной строки
+class MessageRecord:
+    __slots__ = ('id', 'date', 'sender_id', 'text', 'media_path', 'reply_to',
+                 'views', 'forwards', 'edit_date', 'grouped_id', 'entities', 'raw_text', 'media_status')
+
+    def __init__(self, id, date, sender_id=None, text='No Text', media_path=None, reply_to=None,
+                 views=None, forwards=None, edit_date=None, grouped_id=None, entities=None, raw_text=None,
+                 media_status=None):
+        self.id = id
+        self.date = date
+        self.sender_id = sender_id
+        self.text = text
+        self.media_path = media_path
+        self.reply_to = reply_to
+        self.views = views
+        self.forwards = forwards
+        self.edit_date = edit_date
+        self.grouped_id = grouped_id
+        self.entities = entities
+        # Текст без разметки, к которому относятся смещения entities (text содержит markdown Telethon)
+        self.raw_text = raw_text
+        # Состояние скачивания медиа: pending до скачивания, затем done, skipped, failed или missing
+        self.media_status = media_status
+
+    @classmethod
+    def from_message(cls, message, text=None, media_path=None):
+        reply_to = getattr(message.reply_to, 'reply_to_msg_id', None) if message.reply_to else None
+        return cls(
+            id=message.id,
+            date=message.date,
+            sender_id=message.sender_id,
+            text=text if text is not None else (message.text or 'No Text'),
+            media_path=media_path,
+            reply_to=reply_to,
+            views=message.views,
+            forwards=message.forwards,
+            edit_date=message.edit_date,
+            grouped_id=message.grouped_id,
+            entities=entities_to_documents(message.entities),
+            raw_text=message.raw_text if message.entities else None
+        )
+
+    def to_document(self, chat_id):
+        # date и edit_date остаются datetime, в MongoDB они сохраняются как BSON date
+        return {
+            'chat_id': chat_id,
+            'id': self.id,
+            'date': self.date,
+            'sender_id': self.sender_id,
+            'text': self.text,
+            'media_path': self.media_path,
+            'reply_to': self.reply_to,
+            'views': self.views,
+            'forwards': self.forwards,
+            'edit_date': self.edit_date,
+            'grouped_id': self.grouped_id,
+            'entities': self.entities,
+            'raw_text': self.raw_text,
+            'media_status': self.media_status
+        }
+
+def entities_to_documents(entities):
+    if not entities:
+        return None
+    # Смещения сущностей считаются по message.raw_text, он сохраняется рядом в поле raw_text
+    documents = []
+    for entity in entities:
+        document = entity.to_dict()
+        document['type'] = document.pop('_')
+        documents.append(document)
+    return documents
+
+# Поля, которые пишет стадия медиа: правки сообщений их не перезаписывают
+MEDIA_FIELDS = ('media_path', 'media_status')
+
+def record_to_event(chat_id, record):
+    # Формат сообщения для топика raw_data
+    return {
+        'chat_id': chat_id,
+        'message_id': record.id,
+        'date': record.date.isoformat() if record.date else None,
+        'sender_id': record.sender_id,
+        'text': record.text,
+        'reply_to': record.reply_to,
+        'views': record.views,
+        'forwards': record.forwards,
+        'edit_date': record.edit_date.isoformat() if record.edit_date else None,
+        'grouped_id': record.grouped_id,
+        'entities': record.entities,
+        'raw_text': record.raw_text,
+        'media_path': record.media_path,
+        'media_status': record.media_status
+    }
+
+# Внешние приемники отфильтрованных сообщений (кроме MongoDB, которую ведет StorageProvider)
+class OutputSink(ABC):
+    async def start(self):
+        pass
+
+    @abstractmethod
+    async def send(self, chat_id, records):
+        raise NotImplementedError
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        pass
+
+# Отправка в Kafka: продюсер сам собирает пачки и сжимает их, а число неподтвержденных
+# сообщений ограничено, и при переполнении send ждет — это притормаживает парсинг
+class KafkaSink(OutputSink):
+    def __init__(self, producer=None, topic=kafka_topic, max_in_flight=kafka_max_in_flight):
+        if producer is None:
+            if AIOKafkaProducer is None:
+                raise RuntimeError("Для OUTPUT_SINKS=kafka нужен пакет aiokafka")
+            producer = AIOKafkaProducer(
+                bootstrap_servers=kafka_bootstrap_servers,
+                compression_type=kafka_compression or None,
+                linger_ms=kafka_linger_ms,
+                max_batch_size=kafka_max_batch_bytes,
+                acks='all'
+            )
+        self.producer = producer
+        self.topic = topic
+        self.sent = 0
+        self.failed = 0
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._pending = set()
+        self._errors = []
+
+    async def start(self):
+        await self.producer.start()
+
+    async def send(self, chat_id, records):
+        # Ключ — chat_id, чтобы сообщения одного чата попадали в одну партицию по порядку
+        key = str(chat_id).encode()
+        for record in records:
+            await self._in_flight.acquire()
+            try:
+                value = json.dumps(record_to_event(chat_id, record), ensure_ascii=False).encode()
+                delivery = await self.producer.send(self.topic, value=value, key=key)
+            except BaseException:
+                self._in_flight.release()
+                raise
+            self._pending.add(delivery)
+            delivery.add_done_callback(self._on_delivered)
+
+    def _on_delivered(self, delivery):
+        self._pending.discard(delivery)
+        self._in_flight.release()
+        if delivery.cancelled() or delivery.exception():
+            self.failed += 1
+            self._errors.append(delivery.exception() if not delivery.cancelled() else asyncio.CancelledError())
+        else:
+            self.sent += 1
+
+    async def flush(self):
+        await self.producer.flush()
+        if self._pending:
+            await asyncio.gather(*list(self._pending), return_exceptions=True)
+        if self._errors:
+            errors, self._errors = self._errors, []
+            raise RuntimeError(f"Kafka не подтвердила {len(errors)} сообщений: {errors[0]!r}")
+
+    async def close(self):
+        try:
+            await self.flush()
+        finally:
+            await self.producer.stop()
+        logger.info("Kafka: отправлено %s, ошибок %s", self.sent, self.failed)
+
+# Запись одновременно в несколько приемников
+class FanoutSink(OutputSink):
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    async def start(self):
+        for sink in self.sinks:
+            await sink.start()
+
+    async def send(self, chat_id, records):
+        await asyncio.gather(*(sink.send(chat_id, records) for sink in self.sinks))
+
+    async def flush(self):
+        await asyncio.gather(*(sink.flush() for sink in self.sinks))
+
+    async def close(self):
+        for sink in self.sinks:
+            await sink.close()
+
+# В потоковом режиме одно сообщение приходит и событием, и из прямой выгрузки, дочитывающей пропуски.
+# MongoDB повторы поглощает upsert, а во внешний приемник каждая версия сообщения уходит один раз
+class StreamDedupSink(OutputSink):
+    def __init__(self, sink):
+        self.sink = sink
+        self.sent = {}
+
+    async def send(self, chat_id, records):
+        # Правка — новая версия с другим edit_date или текстом (у соседних частей альбома меняется только текст)
+        sent = self.sent.setdefault(chat_id, set())
+        fresh = [record for record in records if self._key(record) not in sent]
+        sent.update(self._key(record) for record in fresh)
+        if fresh:
+            await self.sink.send(chat_id, fresh)
+
+    async def flush(self):
+        await self.sink.flush()
+
+    @staticmethod
+    def _key(record):
+        return record.id, record.edit_date, hash(record.text)
+
+    def forget(self, chat_id, max_id):
+        # Сообщения не выше max_id прямая выгрузка уже прошла, и их события тоже давно пришли
+        self.sent[chat_id] = {key for key in self.sent.get(chat_id, ()) if key[0] > max_id}
+
+def create_output_sink(sink_names=output_sinks):
+    sinks = []
+    for name in sink_names:
+        if name == 'kafka':
+            sinks.append(KafkaSink())
+        elif name != 'mongodb':
+            raise ValueError(f"Неизвестный приемник в OUTPUT_SINKS: {name}")
+    if not sinks:
+        return None
+    return sinks[0] if len(sinks) == 1 else FanoutSink(sinks)
+
+# Воркер потерял аренду чата: его уже выгружает другой воркер, писать пачки и чекпоинт этого чата нельзя
+class LeaseLostError(Exception):
+    pass
+
+async def write_batch(storage_provider, output_sink, chat_id, records, min_id=None, max_id=None, lease_guard=None):
+    if lease_guard and not await lease_guard(chat_id):
+        raise LeaseLostError(f"аренда чата {chat_id} потеряна")
+    # Внешние приемники пишутся до чекпоинта: после сбоя пачка отправится повторно, но не потеряется.
+    # Подтверждения ждем, только когда двигается чекпоинт, иначе сообщения остаются в полете
+    if output_sink and records:
+        await output_sink.send(chat_id, records)
+    if output_sink and (min_id is not None or max_id is not None):
+        await output_sink.flush()
+    inserted, duplicates = await storage_provider.save_batch(records if store_messages else [], chat_id,
+                                                             min_id=min_id, max_id=max_id)
+    if not store_messages:
+        inserted = len(records)
+    MESSAGES_STORED.inc(inserted)
+    MESSAGES_DEDUPLICATED.inc(duplicates)
+    return inserted
+
+# Интерфейс хранилища: парсер работает с ним, а не с конкретной базой
+class StorageProvider(ABC):
+    async def ensure_indexes(self):
+        pass
+
+    @abstractmethod
+    async def save_messages(self, messages, chat_id, session=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update_messages(self, messages, chat_id):
+        raise NotImplementedError
+
+    async def get_last_message_id(self, chat_id):
+        return (await self.get_checkpoint(chat_id))['max_id']
+
+    @abstractmethod
+    async def get_checkpoint(self, chat_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save_checkpoint(self, chat_id, min_id=None, max_id=None, session=None):
+        raise NotImplementedError
+
+    async def save_batch(self, messages, chat_id, min_id=None, max_id=None):
+        result = await self.save_messages(messages, chat_id)
+        await self.save_checkpoint(chat_id, min_id=min_id, max_id=max_id)
+        return result
+
+    @abstractmethod
+    async def update_media_path(self, chat_id, message_id, media_path):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_media_status(self, chat_id, message_id, media_status):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_pending_media(self, chat_id):
+        # ID сообщений чата, медиа которых еще не скачано (pending) или не скачалось (failed)
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save_chat_info(self, chat_id, title, active):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_active_chats(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_dialog_tops(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_dialog_states(self):
+        # {chat_id: (top_message_id, title)} — по ним load_all_chats находит изменившиеся диалоги
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save_dialogs(self, dialogs):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_dialogs_synced_at(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_dialogs_synced_at(self, synced_at):
+        raise NotImplementedError
+
+    # Шардирование: живые воркеры и аренды чатов
+    @abstractmethod
+    async def save_worker_heartbeat(self, worker_id, heartbeat_at):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def remove_worker(self, worker_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_live_workers(self, since):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def acquire_lease(self, chat_id, worker_id, now, expires_at):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def release_lease(self, chat_id, worker_id, finished_at=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_finished_chats(self, chat_ids, since):
+        raise NotImplementedError
+
+    async def get_chats_with_new_messages(self, chat_ids):
+        # Чат без известного верхнего сообщения считаем обновленным, чтобы его не потерять
+        tops = await self.get_dialog_tops()
+        updated = []
+        for chat_id in chat_ids:
+            top_message_id = tops.get(chat_id)
+            if top_message_id is None or top_message_id > await self.get_last_message_id(chat_id):
+                updated.append(chat_id)
+        return updated
+
+    async def load_all_chats(self, max_age=dialog_sync_ttl):
+        # Возвращает True, если top_message_id чатов обновлены в этом запуске и им можно верить
+        synced_at = await self.get_dialogs_synced_at()
+        if synced_at and time.time() - synced_at < max_age:
+            logger.info("Чаты синхронизированы %.0f с назад, пропускаем загрузку.", time.time() - synced_at)
+            return False
+
+        logger.info("Загружаем изменившиеся чаты из Telegram...")
+        started = time.perf_counter()
+        states = await self.get_dialog_states()
+        changed = []
+        # Список проходим целиком: новый диалог со старым последним сообщением может оказаться в любом месте,
+        # экономия только на записи — неизменившиеся диалоги не пишутся
+        async for dialog in client.iter_dialogs():
+            top_message_id = dialog.message.id if dialog.message else 0
+            if states.get(dialog.id) == (top_message_id, dialog.title):
+                continue
+            changed.append({
+                'chat_id': dialog.id,
+                'title': dialog.title,
+                'top_message_id': top_message_id,
+                'top_message_date': dialog.date
+            })
+        await self.save_dialogs(changed)
+        await self.set_dialogs_synced_at(time.time())
+        LOAD_ALL_CHATS_SECONDS.observe(time.perf_counter() - started)
+        logger.info("Чаты загружены, изменилось %s.", len(changed))
+        return True
+
+    def close(self):
+        pass
+
 # Класс для работы с MongoDB
-class MongoDBProvider:
-    def __init__(self, mongodb_uri):
-        print("Инициализация MongoDB клиента...")
-        self.client = AsyncIOMotorClient(mongodb_uri)
+class MongoDBProvider(StorageProvider):
+    def __init__(self, mongodb_uri, batch_size=mongodb_batch_size, write_concern=mongodb_write_concern, motor_client=None,
+                 max_pool_size=mongodb_max_pool_size, min_pool_size=mongodb_min_pool_size):
+        logger.info("Инициализация MongoDB клиента...")
+        self.client = motor_client or AsyncIOMotorClient(mongodb_uri, maxPoolSize=max_pool_size, minPoolSize=min_pool_size)
         self.db = self.client['telegram_db']
-        self.messages_collection = self.db['messages']
+        self.batch_size = batch_size
+        # w может быть числом реплик или строкой вроде 'majority'
+        w = int(write_concern) if str(write_concern).isdigit() else write_concern
+        # При w=0 MongoDB не подтверждает запись: нельзя узнать число добавленных и нельзя двигать чекпоинт
+        if w == 0:
+            raise ValueError("MONGODB_WRITE_CONCERN=0 не поддерживается: нужна подтвержденная запись (1 или majority)")
+        self.messages_collection = self.db.get_collection('messages', write_concern=WriteConcern(w=w))
         self.last_ids_collection = self.db['last_ids']
         self.chats_collection = self.db['chats']
+        self.sync_state_collection = self.db['sync_state']
+        self.workers_collection = self.db['shard_workers']
+        self.leases_collection = self.db['chat_leases']
+        self.transactions_supported = None
+
+    async def ensure_indexes(self):
+        # Уникальный индекс нужен для идемпотентных upsert'ов в save_messages
+        await self.messages_collection.create_index(
+            [('chat_id', ASCENDING), ('id', ASCENDING)],
+            unique=True,
+            name='chat_id_id_unique'
+        )
+        # Индексы по дате, отправителю и тексту для чтения потребителями (query.py), они же покрывают chat_id + date
+        await ensure_query_indexes(self.messages_collection)
+        await self.last_ids_collection.create_index([('chat_id', ASCENDING)], unique=True, name='chat_id_unique')
+        # Для поиска недокачанного медиа при старте
+        await self.messages_collection.create_index(
+            [('chat_id', ASCENDING), ('media_status', ASCENDING)], name='chat_id_media_status'
+        )
 
-    async def save_messages(self, messages, chat_id):
-        print(f"Сохраняем {len(messages)} новых сообщений в базу для чата {chat_id}...")
-        for message in messages:
-            message_parts = message.split('|')
-            message_id = int(message_parts[0])
-            message_date = message_parts[1]
-            sender_id = int(message_parts[2]) if message_parts[2] != 'None' else None
-            text = message_parts[3] if len(message_parts) > 3 else 'No Text'
-            media_path = message_parts[4] if len(message_parts) > 4 else None
-
-            existing_message = await self.messages_collection.find_one({'chat_id': chat_id, 'id': message_id})
-            if not existing_message:
-                await self.messages_collection.insert_one({
-                    'chat_id': chat_id,
-                    'id': message_id,
-                    'date': message_date,
-                    'sender_id': sender_id,
-                    'text': text,
-                    'media_path': media_path
-                })
+    def query(self):
+        return MessageQuery(self.messages_collection)
 
-    async def get_last_message_id(self, chat_id):
+    async def detect_transactions(self):
+        # Транзакции есть только у replica set и mongos, у одиночного mongod их нет
+        try:
+            hello = await self.client.admin.command('hello')
+        except Exception:
+            return False
+        return 'setName' in hello or hello.get('msg') == 'isdbgrid'
+
+    async def save_messages(self, messages, chat_id, session=None):
+        if not messages:
+            return 0, 0
+        logger.debug("Сохраняем %s новых сообщений в базу для чата %s...", len(messages), chat_id)
+        started = time.perf_counter()
+        inserted = 0
+        duplicates = 0
+        for start in range(0, len(messages), self.batch_size):
+            operations = [
+                UpdateOne(
+                    {'chat_id': chat_id, 'id': record.id},
+                    {'$setOnInsert': record.to_document(chat_id)},
+                    upsert=True
+                )
+                for record in messages[start:start + self.batch_size]
+            ]
+
+            batch_inserted = await self._bulk_upsert(operations, session)
+            inserted += batch_inserted
+            duplicates += len(operations) - batch_inserted
+
+        SAVE_MESSAGES_SECONDS.observe(time.perf_counter() - started)
+        logger.debug("Чат %s: добавлено %s, дубликатов %s", chat_id, inserted, duplicates)
+        return inserted, duplicates
+
+    async def update_messages(self, messages, chat_id):
+        # Для отредактированных сообщений: обновляем все поля, кроме media_path и media_status — их пишет стадия медиа
+        operations = [
+            UpdateOne(
+                {'chat_id': chat_id, 'id': record.id},
+                {'$set': {key: value for key, value in record.to_document(chat_id).items() if key not in MEDIA_FIELDS}},
+                upsert=True
+            )
+            for record in messages
+        ]
+        if operations:
+            await self._bulk_upsert(operations)
+
+    async def _bulk_upsert(self, operations, session=None):
+        try:
+            result = await self.messages_collection.bulk_write(operations, ordered=False, session=session)
+            return result.upserted_count
+        except BulkWriteError as e:
+            # Параллельный upsert того же (chat_id, id) падает с DuplicateKeyError — это тоже дубликат
+            if any(error['code'] != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+            return e.details.get('nUpserted', 0)
+
+    async def get_checkpoint(self, chat_id):
+        # Чекпоинт — непрерывный диапазон [min_id, max_id] уже выгруженных сообщений чата
         last_id_entry = await self.last_ids_collection.find_one({'chat_id': chat_id})
-        return last_id_entry['last_message_id'] if last_id_entry else 0
+        if not last_id_entry:
+            return {'min_id': None, 'max_id': 0}
+        max_id = last_id_entry.get('max_id', last_id_entry.get('last_message_id', 0))
+        # Старые записи без min_id появились после прямой выгрузки с самого начала чата
+        min_id = last_id_entry.get('min_id', 1 if max_id else None)
+        return {'min_id': min_id, 'max_id': max_id}
+
+    async def save_checkpoint(self, chat_id, min_id=None, max_id=None, session=None):
+        # $min/$max только расширяют диапазон: при уже существующем диапазоне прямая выгрузка двигает max_id,
+        # обратная — min_id, и они не мешают друг другу (новый чат ChatScheduler выгружает по очереди)
+        update = {}
+        if min_id is not None:
+            update['$min'] = {'min_id': min_id}
+        if max_id is not None:
+            update['$max'] = {'max_id': max_id, 'last_message_id': max_id}
+        if not update:
+            return
+        await self.last_ids_collection.update_one({'chat_id': chat_id}, update, upsert=True, session=session)
+
+    async def save_batch(self, messages, chat_id, min_id=None, max_id=None):
+        # Пачка и чекпоинт пишутся одной транзакцией, если сервер это поддерживает
+        if self.transactions_supported is None:
+            self.transactions_supported = await self.detect_transactions()
+        if self.transactions_supported:
+            try:
+                async with await self.client.start_session() as session:
+                    async with session.start_transaction():
+                        result = await self.save_messages(messages, chat_id, session=session)
+                        await self.save_checkpoint(chat_id, min_id=min_id, max_id=max_id, session=session)
+                return result
+            except PyMongoError as e:
+                logger.warning("Транзакция для чата %s не удалась, пишем без нее: %s", chat_id, e)
+        # Без транзакции сначала сообщения, потом чекпоинт: при сбое между ними пачка просто перечитается
+        result = await self.save_messages(messages, chat_id)
+        await self.save_checkpoint(chat_id, min_id=min_id, max_id=max_id)
+        return result
+
+    async def update_media_path(self, chat_id, message_id, media_path):
+        await self.messages_collection.update_one(
+            {'chat_id': chat_id, 'id': message_id},
+            {'$set': {'media_path': media_path, 'media_status': 'done'}}
+        )
 
-    async def save_last_message_id(self, chat_id, message_id):
-        await self.last_ids_collection.update_one(
-            {'chat_id': chat_id},
-            {'$set': {'last_message_id': message_id}},
-            upsert=True
+    async def set_media_status(self, chat_id, message_id, media_status):
+        await self.messages_collection.update_one(
+            {'chat_id': chat_id, 'id': message_id},
+            {'$set': {'media_status': media_status}}
         )
 
+    async def get_pending_media(self, chat_id):
+        cursor = self.messages_collection.find(
+            {'chat_id': chat_id, 'media_status': {'$in': ['pending', 'failed']}}, {'_id': 0, 'id': 1}
+        ).sort('id', ASCENDING)
+        return [document['id'] async for document in cursor]
+
     async def save_chat_info(self, chat_id, title, active):
         await self.chats_collection.update_one(
             {'chat_id': chat_id},
@@ -79,11 +865,201 @@ class MongoDBProvider:
         active_chats = await self.chats_collection.find({'active': True}).to_list(length=None)
         return [chat['chat_id'] for chat in active_chats]
 
-    async def load_all_chats(self):
-        print("Загружаем все чаты из Telegram...")
-        async for dialog in client.iter_dialogs():
-            await self.save_chat_info(dialog.id, dialog.title, active=False)
-        print("Чаты загружены.")
+    async def get_dialog_tops(self):
+        tops = {}
+        async for chat in self.chats_collection.find({}, {'chat_id': 1, 'top_message_id': 1}):
+            if 'top_message_id' in chat:
+                tops[chat['chat_id']] = chat['top_message_id']
+        return tops
+
+    async def get_dialog_states(self):
+        states = {}
+        async for chat in self.chats_collection.find({}, {'chat_id': 1, 'top_message_id': 1, 'title': 1}):
+            if 'top_message_id' in chat:
+                states[chat['chat_id']] = (chat['top_message_id'], chat.get('title'))
+        return states
+
+    async def save_dialogs(self, dialogs):
+        if not dialogs:
+            return
+        await self.chats_collection.bulk_write([
+            UpdateOne(
+                {'chat_id': dialog['chat_id']},
+                {'$set': dialog, '$setOnInsert': {'active': False}},
+                upsert=True
+            )
+            for dialog in dialogs
+        ], ordered=False)
+
+    async def get_dialogs_synced_at(self):
+        state = await self.sync_state_collection.find_one({'_id': 'dialogs'})
+        return state['synced_at'] if state else None
+
+    async def set_dialogs_synced_at(self, synced_at):
+        await self.sync_state_collection.update_one(
+            {'_id': 'dialogs'},
+            {'$set': {'synced_at': synced_at}},
+            upsert=True
+        )
+
+    async def save_worker_heartbeat(self, worker_id, heartbeat_at):
+        await self.workers_collection.update_one(
+            {'_id': worker_id},
+            {'$set': {'heartbeat_at': heartbeat_at}},
+            upsert=True
+        )
+
+    async def remove_worker(self, worker_id):
+        await self.workers_collection.delete_one({'_id': worker_id})
+
+    async def get_live_workers(self, since):
+        return [worker['_id'] async for worker in self.workers_collection.find({'heartbeat_at': {'$gte': since}})]
+
+    async def acquire_lease(self, chat_id, worker_id, now, expires_at):
+        # Аренду можно взять, если она свободна, истекла или уже наша. Если ее держит другой воркер,
+        # фильтр не совпадет, upsert попробует вставить тот же _id и получит ошибку дубликата
+        try:
+            await self.leases_collection.update_one(
+                {'_id': chat_id, '$or': [{'owner': worker_id}, {'owner': None}, {'expires_at': {'$lt': now}}]},
+                {'$set': {'owner': worker_id, 'expires_at': expires_at}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def release_lease(self, chat_id, worker_id, finished_at=None):
+        update = {'owner': None, 'expires_at': 0}
+        if finished_at is not None:
+            update['finished_at'] = finished_at
+        await self.leases_collection.update_one({'_id': chat_id, 'owner': worker_id}, {'$set': update})
+
+    async def get_finished_chats(self, chat_ids, since):
+        cursor = self.leases_collection.find({'_id': {'$in': chat_ids}, 'finished_at': {'$gte': since}}, {'_id': 1})
+        return {lease['_id'] async for lease in cursor}
+
+    async def get_chats_with_new_messages(self, chat_ids):
+        # Два запроса на весь список вместо двух на каждый чат
+        tops = {}
+        async for chat in self.chats_collection.find({'chat_id': {'$in': chat_ids}}, {'chat_id': 1, 'top_message_id': 1}):
+            if 'top_message_id' in chat:
+                tops[chat['chat_id']] = chat['top_message_id']
+        last_ids = {}
+        async for entry in self.last_ids_collection.find({'chat_id': {'$in': chat_ids}}):
+            last_ids[entry['chat_id']] = entry.get('max_id', entry.get('last_message_id', 0))
+        return [chat_id for chat_id in chat_ids
+                if chat_id not in tops or tops[chat_id] > last_ids.get(chat_id, 0)]
+
+    def close(self):
+        self.client.close()
+
+# Хранилище в памяти процесса: для тестов и прогонов без MongoDB (PROVIDER_TYPE=memory)
+class MemoryStorageProvider(StorageProvider):
+    def __init__(self):
+        self.messages = {}
+        self.last_ids = {}
+        self.chats = {}
+        self.dialogs_synced_at = None
+        self.workers = {}
+        self.leases = {}
+
+    async def save_messages(self, messages, chat_id, session=None):
+        inserted = 0
+        for record in messages:
+            key = (chat_id, record.id)
+            if key not in self.messages:
+                self.messages[key] = record.to_document(chat_id)
+                inserted += 1
+        return inserted, len(messages) - inserted
+
+    async def update_messages(self, messages, chat_id):
+        for record in messages:
+            document = self.messages.setdefault((chat_id, record.id), {'media_path': None, 'media_status': None})
+            document.update({key: value for key, value in record.to_document(chat_id).items() if key not in MEDIA_FIELDS})
+
+    async def get_checkpoint(self, chat_id):
+        entry = self.last_ids.get(chat_id)
+        if not entry:
+            return {'min_id': None, 'max_id': 0}
+        return {'min_id': entry.get('min_id'), 'max_id': entry.get('max_id', 0)}
+
+    async def save_checkpoint(self, chat_id, min_id=None, max_id=None, session=None):
+        if min_id is None and max_id is None:
+            return
+        entry = self.last_ids.setdefault(chat_id, {'chat_id': chat_id})
+        if min_id is not None:
+            entry['min_id'] = min(entry.get('min_id', min_id), min_id)
+        if max_id is not None:
+            entry['max_id'] = entry['last_message_id'] = max(entry.get('max_id', max_id), max_id)
+
+    async def update_media_path(self, chat_id, message_id, media_path):
+        if (chat_id, message_id) in self.messages:
+            self.messages[(chat_id, message_id)].update(media_path=media_path, media_status='done')
+
+    async def set_media_status(self, chat_id, message_id, media_status):
+        if (chat_id, message_id) in self.messages:
+            self.messages[(chat_id, message_id)]['media_status'] = media_status
+
+    async def get_pending_media(self, chat_id):
+        return sorted(message_id for (message_chat_id, message_id), document in self.messages.items()
+                      if message_chat_id == chat_id and document.get('media_status') in ('pending', 'failed'))
+
+    async def save_chat_info(self, chat_id, title, active):
+        entry = self.chats.setdefault(chat_id, {'chat_id': chat_id, 'active': active})
+        entry['title'] = title
+
+    async def get_active_chats(self):
+        return [chat_id for chat_id, chat in self.chats.items() if chat['active']]
+
+    async def get_dialog_tops(self):
+        return {chat_id: chat['top_message_id'] for chat_id, chat in self.chats.items() if 'top_message_id' in chat}
+
+    async def get_dialog_states(self):
+        return {chat_id: (chat['top_message_id'], chat.get('title'))
+                for chat_id, chat in self.chats.items() if 'top_message_id' in chat}
+
+    async def save_dialogs(self, dialogs):
+        for dialog in dialogs:
+            self.chats.setdefault(dialog['chat_id'], {'active': False}).update(dialog)
+
+    async def get_dialogs_synced_at(self):
+        return self.dialogs_synced_at
+
+    async def set_dialogs_synced_at(self, synced_at):
+        self.dialogs_synced_at = synced_at
+
+    async def save_worker_heartbeat(self, worker_id, heartbeat_at):
+        self.workers[worker_id] = heartbeat_at
+
+    async def remove_worker(self, worker_id):
+        self.workers.pop(worker_id, None)
+
+    async def get_live_workers(self, since):
+        return [worker_id for worker_id, heartbeat_at in self.workers.items() if heartbeat_at >= since]
+
+    async def acquire_lease(self, chat_id, worker_id, now, expires_at):
+        lease = self.leases.setdefault(chat_id, {'owner': None, 'expires_at': 0})
+        if lease['owner'] not in (None, worker_id) and lease['expires_at'] >= now:
+            return False
+        lease.update(owner=worker_id, expires_at=expires_at)
+        return True
+
+    async def release_lease(self, chat_id, worker_id, finished_at=None):
+        lease = self.leases.get(chat_id)
+        if lease and lease['owner'] == worker_id:
+            lease.update(owner=None, expires_at=0)
+            if finished_at is not None:
+                lease['finished_at'] = finished_at
+
+    async def get_finished_chats(self, chat_ids, since):
+        return {chat_id for chat_id in chat_ids if self.leases.get(chat_id, {}).get('finished_at', -1) >= since}
+
+def create_storage_provider(provider_type=provider_type):
+    if provider_type == 'mongodb':
+        return MongoDBProvider(mongodb_uri)
+    if provider_type == 'memory':
+        return MemoryStorageProvider()
+    raise ValueError(f"Неизвестный PROVIDER_TYPE: {provider_type}")
 
 def load_filters():
     filters = {}
@@ -91,7 +1067,7 @@ def load_filters():
         with open('filters.json', 'r') as f:
             filters = json.load(f)
     except (FileNotFoundError, json.JSONDecodeError):
-        print("Файл filters.json не найден или поврежден, работаем без фильтров.")
+        logger.warning("Файл filters.json не найден или поврежден, работаем без фильтров.")
         return {
             "filter_message_types": [],
             "filter_keywords": [],
@@ -110,38 +1086,38 @@ def load_filters():
         try:
             local_tz = pytz.timezone(str(local_tz))
         except pytz.exceptions.UnknownTimeZoneError:
-            print(f"Не удалось определить часовой пояс, используем UTC по умолчанию.")
+            logger.warning("Не удалось определить часовой пояс, используем UTC по умолчанию.")
             local_tz = pytz.UTC
-    print(f"Используемый часовой пояс: {local_tz}")
+    logger.info("Используемый часовой пояс: %s", local_tz)
 
     # Логируем текущее время системы для проверки
     current_time_local = datetime.now(local_tz)
     current_time_utc = current_time_local.astimezone(pytz.UTC)
-    print(f"Текущее время системы (местное, {local_tz}): {current_time_local}")
-    print(f"Текущее время системы (UTC): {current_time_utc}")
+    logger.debug("Текущее время системы (местное, %s): %s", local_tz, current_time_local)
+    logger.debug("Текущее время системы (UTC): %s", current_time_utc)
 
     if "filter_date_from" in filters and filters["filter_date_from"]:
         try:
             dt = datetime.strptime(filters["filter_date_from"], '%Y-%m-%d %H:%M:%S')
-            print(f"filter_date_from (исходное, местное время): {dt}")
+            logger.debug("filter_date_from (исходное, местное время): %s", dt)
             dt = local_tz.localize(dt)  # Привязываем к локальному часовому поясу
-            print(f"filter_date_from (после привязки к {local_tz}): {dt}")
+            logger.debug("filter_date_from (после привязки к %s): %s", local_tz, dt)
             filters["filter_date_from"] = dt.astimezone(pytz.UTC)  # Преобразуем в UTC
-            print(f"filter_date_from (в UTC): {filters['filter_date_from']}")
+            logger.debug("filter_date_from (в UTC): %s", filters['filter_date_from'])
         except ValueError:
-            print("Неверный формат даты в filter_date_from, игнорируем фильтр.")
+            logger.warning("Неверный формат даты в filter_date_from, игнорируем фильтр.")
             filters["filter_date_from"] = None
 
     if "filter_date_to" in filters and filters["filter_date_to"]:
         try:
             dt = datetime.strptime(filters["filter_date_to"], '%Y-%m-%d %H:%M:%S')
-            print(f"filter_date_to (исходное, местное время): {dt}")
+            logger.debug("filter_date_to (исходное, местное время): %s", dt)
             dt = local_tz.localize(dt)  # Привязываем к локальному часовому поясу
-            print(f"filter_date_to (после привязки к {local_tz}): {dt}")
+            logger.debug("filter_date_to (после привязки к %s): %s", local_tz, dt)
             filters["filter_date_to"] = dt.astimezone(pytz.UTC)  # Преобразуем в UTC
-            print(f"filter_date_to (в UTC): {filters['filter_date_to']}")
+            logger.debug("filter_date_to (в UTC): %s", filters['filter_date_to'])
         except ValueError:
-            print("Неверный формат даты в filter_date_to, игнорируем фильтр.")
+            logger.warning("Неверный формат даты в filter_date_to, игнорируем фильтр.")
             filters["filter_date_to"] = None
 
     filters.setdefault("filter_message_types", [])
@@ -155,18 +1131,94 @@ def load_filters():
 
     return filters
 
-    # Функция для выгрузки сообщений из чата
-async def fetch_chat_messages(chat_id, filters, batch_size=50):
-    storage_provider = MongoDBProvider(mongodb_uri)
-
-    try:
-        chat = await client.get_entity(chat_id)
-    except ValueError as e:
-        print(f"Ошибка: Не удалось найти чат с ID {chat_id}. Причина: {e}")
-        return
-    except Exception as e:
-        print(f"Неизвестная ошибка при получении чата с ID {chat_id}: {e}")
-        return
+def build_message_record(message, message_filter, media_jobs, text=None):
+    # Медиа скачивается отдельно, после сохранения пачки, здесь только ставим его в список.
+    # Запись уходит в базу с media_status='pending', чтобы после сбоя медиа можно было докачать
+    record = MessageRecord.from_message(message, text=text)
+    if download_media_enabled and message_filter.should_download(message):
+        media_jobs.append(message)
+        record.media_status = 'pending'
+    # Построчный лог на каждое сообщение только в DEBUG, проверка уровня дешевле вызова logger.debug
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Сообщение прошло фильтр: %s|%s|%s|%s", record.id, record.date, record.sender_id, record.text)
+    return record
+
+# Максимальное число медиафайлов в одном альбоме Telegram
+ALBUM_MAX_SIZE = 10
+
+async def fetch_album_caption(chat_id, album):
+    # Альбом начался до min_id: подпись может быть в уже сохраненной части, запрашиваем только соседние ID
+    first_part = album[0]
+    missing = ALBUM_MAX_SIZE - len(album)
+    if missing <= 0:
+        return None
+    ids = list(range(max(1, first_part.id - missing), first_part.id))
+    for message in await client.get_messages(chat_id, ids=ids):
+        if message and message.grouped_id == first_part.grouped_id and message.text:
+            return message.text
+    return None
+
+async def fetch_album_parts(chat_id, message):
+    # Части альбома идут подряд по ID, поэтому соседей ищем не дальше ALBUM_MAX_SIZE в обе стороны
+    ids = [message_id for message_id in range(max(1, message.id - ALBUM_MAX_SIZE + 1), message.id + ALBUM_MAX_SIZE)
+           if message_id != message.id]
+    parts = [part for part in await client.get_messages(chat_id, ids=ids)
+             if part and part.grouped_id == message.grouped_id]
+    return sorted(parts + [message], key=lambda part: part.id)
+
+async def collect_album_records(chat_id, album, message_filter, media_jobs, at_boundary=False):
+    logger.debug("Обнаружен альбом с grouped_id %s, найдено %s медиафайлов", album[0].grouped_id, len(album))
+    album_text = next((part.text for part in album if part.text), None)
+    if album_text is None and at_boundary:
+        album_text = await fetch_album_caption(chat_id, album)
+
+    records = []
+    for part in album:
+        if not message_filter.should_process(part):
+            continue
+        records.append(build_message_record(part, message_filter, media_jobs, text=album_text or 'No Text'))
+    return records
+
+# Сводка по чату вместо строки на каждое сообщение: не чаще раза в LOG_SUMMARY_INTERVAL секунд
+class ChatLogSummary:
+    def __init__(self, chat_id, direction, interval=log_summary_interval):
+        self.chat_id = chat_id
+        self.direction = direction
+        self.interval = interval
+        self.accepted = 0
+        self.filtered = 0
+        self._next_log = time.monotonic() + interval
+
+    def add(self, accepted, filtered):
+        self.accepted += accepted
+        self.filtered += filtered
+
+    def tick(self):
+        if time.monotonic() >= self._next_log:
+            self.log()
+
+    def log(self):
+        self._next_log = time.monotonic() + self.interval
+        if self.accepted or self.filtered:
+            logger.info("Чат %s (%s): прошло фильтр %s, отфильтровано %s", self.chat_id, self.direction,
+                        self.accepted, self.filtered,
+                        extra={'chat_id': self.chat_id, 'accepted': self.accepted, 'filtered': self.filtered})
+
+# Сколько просмотренных сообщений можно пропустить без сохранения чекпоинта
+CHECKPOINT_INTERVAL = 1000
+
+# Функция для выгрузки сообщений из чата
+async def fetch_chat_messages(storage_provider, chat_id, message_filter, batch_size=mongodb_batch_size, chat=None, media_downloader=None,
+                              direction='forward', output_sink=None, lease_guard=None):
+    if chat is None:
+        try:
+            chat = await client.get_entity(chat_id)
+        except ValueError as e:
+            logger.error("Ошибка: Не удалось найти чат с ID %s. Причина: %s", chat_id, e)
+            return 0
+        except Exception as e:
+            logger.error("Неизвестная ошибка при получении чата с ID %s: %s", chat_id, e)
+            return 0
 
     if isinstance(chat, (types.Chat, types.Channel)):
         title = chat.title
@@ -176,267 +1228,1209 @@ async def fetch_chat_messages(chat_id, filters, batch_size=50):
         title = 'Unknown Chat'
     await storage_provider.save_chat_info(chat.id, title, active=False)
 
-    last_fetched_id = await storage_provider.get_last_message_id(chat_id)
-    new_messages = []
-    processed_grouped_ids = set()
-
-    async for message in client.iter_messages(chat_id, min_id=last_fetched_id, reverse=True):
-        if message.id <= last_fetched_id:
-            continue
+    checkpoint = await storage_provider.get_checkpoint(chat_id)
+    backward = direction == 'backward'
+    if backward:
+        # Обратная выгрузка идет от новых к старым, ниже уже покрытого диапазона
+        if checkpoint['min_id'] is not None and checkpoint['min_id'] <= 1:
+            logger.info("История чата %s уже выгружена полностью", chat_id)
+            return 0
+        start_id = checkpoint['min_id'] or 0
+        messages_iterator = client.iter_messages(chat_id, max_id=start_id)
+    else:
+        start_id = checkpoint['max_id']
+        messages_iterator = client.iter_messages(chat_id, min_id=start_id, reverse=True)
 
-        if not should_process_message(message, filters):
-            print(f"Сообщение {message.id} отфильтровано: date={message.date}, text={message.text}")
+    new_messages = []
+    media_jobs = []
+    summary = ChatLogSummary(chat_id, direction)
+    # Время по стадиям: ожидание Telegram, фильтрация и сборка записей, запись пачек, ожидание места в очереди медиа
+    stage_seconds = {'telegram': 0.0, 'filter': 0.0, 'store': 0.0, 'media_queue': 0.0}
+    batch_seconds = 0.0
+    stored_count = 0
+    seen_count = 0
+    reported_seen = reported_filtered = 0
+    unsaved_count = 0
+    unconfirmed_count = 0
+    first_seen_id = None
+    last_seen_id = None
+    # Части альбома идут подряд по ID, поэтому копим их, пока не сменится grouped_id
+    album = []
+    album_at_boundary = False
+
+    # Метрики сбрасываются после каждой пачки, чтобы FloodWait посреди чата не терял уже учтенное
+    def report_metrics():
+        nonlocal reported_seen, reported_filtered
+        for stage, seconds in stage_seconds.items():
+            STAGE_SECONDS.inc(seconds, stage=stage)
+            stage_seconds[stage] = 0.0
+        MESSAGES_SEEN.inc(seen_count - reported_seen)
+        MESSAGES_FILTERED.inc(summary.filtered - reported_filtered)
+        reported_seen, reported_filtered = seen_count, summary.filtered
+
+    async def save_batch(final=False):
+        nonlocal new_messages, stored_count, unsaved_count, unconfirmed_count, batch_seconds
+        # Чекпоинт не должен проскочить части альбома, которые еще лежат в буфере
+        min_id = max_id = None
+        if backward:
+            if final:
+                min_id = 1
+            elif last_seen_id is not None:
+                min_id = album[0].id + 1 if album else last_seen_id
+            if start_id == 0 and first_seen_id is not None:
+                max_id = first_seen_id
+        elif last_seen_id is not None:
+            max_id = album[0].id - 1 if album else last_seen_id
+            if start_id == 0:
+                min_id = 1
+        # С внешним приемником ожидание подтверждений стоит round-trip до брокера, поэтому чекпоинт
+        # двигается раз в OUTPUT_CHECKPOINT_INTERVAL отправленных сообщений, а пачки между ними идут без ожидания
+        if output_sink:
+            unconfirmed_count += len(new_messages)
+            if not final and 0 < unconfirmed_count < output_checkpoint_interval:
+                min_id = max_id = None
+            else:
+                unconfirmed_count = 0
+        started = time.perf_counter()
+        stored_count += await write_batch(storage_provider, output_sink, chat_id, new_messages,
+                                          min_id=min_id, max_id=max_id, lease_guard=lease_guard)
+        stored = time.perf_counter()
+        stage_seconds['store'] += stored - started
+        new_messages = []
+        unsaved_count = 0
+        await submit_media_jobs(media_downloader, chat_id, media_jobs)
+        stage_seconds['media_queue'] += time.perf_counter() - stored
+        batch_seconds += time.perf_counter() - started
+        report_metrics()
+
+    fetch_started = mark = time.perf_counter()
+    batch_mark = 0.0
+    async for message in messages_iterator:
+        received = time.perf_counter()
+        stage_seconds['telegram'] += received - mark
+        mark = received
+        if start_id and (message.id >= start_id if backward else message.id <= start_id):
             continue
 
-        if message.grouped_id and message.grouped_id not in processed_grouped_ids:
-            group_messages = []
-            async for msg in client.iter_messages(chat_id, limit=100):
-                if msg.grouped_id == message.grouped_id:
-                    group_messages.append(msg)
-
-            print(f"Обнаружен альбом с grouped_id {message.grouped_id}, найдено {len(group_messages)} медиафайлов")
-            processed_grouped_ids.add(message.grouped_id)
-
-            album_text = group_messages[0].text if group_messages and group_messages[0].text else 'No Text'
-            for group_msg in group_messages:
-                if not should_process_message(group_msg, filters):
+        if album and message.grouped_id != album[0].grouped_id:
+            records = await collect_album_records(chat_id, album, message_filter, media_jobs,
+                                                  album_at_boundary and not backward)
+            summary.add(len(records), len(album) - len(records))
+            new_messages.extend(records)
+            album = []
+
+        if message.grouped_id:
+            if not album:
+                album_at_boundary = seen_count == 0 and start_id > 0
+            album.append(message)
+        elif not message_filter.should_process(message):
+            summary.filtered += 1
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Сообщение %s отфильтровано: date=%s, text=%s", message.id, message.date, message.text)
+        else:
+            new_messages.append(build_message_record(message, message_filter, media_jobs))
+            summary.accepted += 1
+        seen_count += 1
+        unsaved_count += 1
+        if first_seen_id is None:
+            first_seen_id = message.id
+        last_seen_id = message.id
+
+        # Чекпоинт двигается после каждой пачки, а при сильной фильтрации — не реже чем раз в CHECKPOINT_INTERVAL сообщений
+        if len(new_messages) >= batch_size or unsaved_count >= CHECKPOINT_INTERVAL:
+            await save_batch()
+        summary.tick()
+        mark = time.perf_counter()
+        # Запись пачки внутри итерации учитывается отдельно, в store и media_queue
+        stage_seconds['filter'] += mark - received - (batch_seconds - batch_mark)
+        batch_mark = batch_seconds
+
+    if album:
+        records = await collect_album_records(chat_id, album, message_filter, media_jobs,
+                                              album_at_boundary and not backward)
+        summary.add(len(records), len(album) - len(records))
+        new_messages.extend(records)
+        album = []
+
+    if new_messages or unsaved_count or unconfirmed_count or backward:
+        await save_batch(final=True)
+
+    summary.log()
+    report_metrics()
+    FETCH_CHAT_SECONDS.observe(time.perf_counter() - fetch_started, direction=direction)
+    return stored_count
+
+async def submit_media_jobs(media_downloader, chat_id, media_jobs):
+    # Задачи ставим только после сохранения пачки, чтобы media_path было куда записать
+    if media_downloader:
+        for message in media_jobs:
+            await media_downloader.submit(chat_id, message)
+    media_jobs.clear()
+
+# Микропакеты потокового режима: сообщения из событий копятся и сбрасываются по размеру или по времени
+class StreamBatcher:
+    def __init__(self, storage_provider, media_downloader=None, batch_size=stream_batch_size,
+                 flush_interval=stream_flush_interval, output_sink=None, lease_guard=None):
+        self.storage_provider = storage_provider
+        self.lease_guard = lease_guard
+        self.media_downloader = media_downloader
+        self.output_sink = output_sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.new_records = {}
+        self.edited_records = {}
+        self.media_jobs = {}
+        self.pending_count = 0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.flush()
+
+    async def add(self, chat_id, records, media_jobs):
+        self.new_records.setdefault(chat_id, []).extend(records)
+        self.media_jobs.setdefault(chat_id, []).extend(media_jobs)
+        self.pending_count += len(records)
+        if self.pending_count >= self.batch_size:
+            await self.flush()
+
+    async def add_edit(self, chat_id, record):
+        self.edited_records.setdefault(chat_id, []).append(record)
+        self.pending_count += 1
+        if self.pending_count >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            new_records, self.new_records = self.new_records, {}
+            edited_records, self.edited_records = self.edited_records, {}
+            media_jobs, self.media_jobs = self.media_jobs, {}
+            self.pending_count = 0
+            for chat_id, records in new_records.items():
+                # Сообщения чата с потерянной арендой пропускаем: их дочитает прямая выгрузка нового владельца
+                if not await self._holds(chat_id):
                     continue
-
-                text = album_text.replace('|', ', ')
-                media_path = None
-                if download_media_enabled and should_download_media(group_msg, filters):
-                    media_path = await group_msg.download_media(file=download_media_path)
-                    if media_path:
-                        print(f"Скачан медиафайл: {media_path}")
-                    else:
-                        print(f"Не удалось скачать медиа для сообщения {group_msg.id}")
-                    if media_path and not is_valid_media_extension(media_path, filters):
-                        print(f"Медиафайл {media_path} удален: неподдерживаемое расширение")
-                        os.remove(media_path)
-                        media_path = None
-
-                sender_id = str(group_msg.sender_id) if group_msg.sender_id else 'None'
-                message_entry = f"{group_msg.id}|{group_msg.date}|{sender_id}|{text}|{media_path}"
-                print(f"Сообщение прошло фильтр: {message_entry}")
-                new_messages.append(message_entry)
-
-        elif not message.grouped_id:
-            text = message.text.replace('|', ', ') if message.text else 'No Text'
-            media_path = None
-            if download_media_enabled and should_download_media(message, filters):
-                media_path = await message.download_media(file=download_media_path)
-                if media_path:
-                    print(f"Скачан медиафайл: {media_path}")
+                if self.output_sink:
+                    await self.output_sink.send(chat_id, records)
+                if store_messages:
+                    inserted, duplicates = await self.storage_provider.save_messages(records, chat_id)
+                    MESSAGES_STORED.inc(inserted)
+                    MESSAGES_DEDUPLICATED.inc(duplicates)
+                await submit_media_jobs(self.media_downloader, chat_id, media_jobs.get(chat_id, []))
+            # Правки пишутся после новых сообщений, чтобы правка не перезаписалась исходной версией
+            for chat_id, records in edited_records.items():
+                if not await self._holds(chat_id):
+                    continue
+                if self.output_sink:
+                    await self.output_sink.send(chat_id, records)
+                if store_messages:
+                    await self.storage_provider.update_messages(records, chat_id)
+            # Ошибки доставки потоковых сообщений всплывают здесь, а не в пачке другого чата
+            if self.output_sink:
+                await self.output_sink.flush()
+
+    async def _holds(self, chat_id):
+        return not self.lease_guard or await self.lease_guard(chat_id)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Ошибка при сохранении потоковых сообщений: %s", e)
+
+async def run_stream(chat_ids, message_filter, storage_provider, media_downloader=None, output_sink=None,
+                     lease_guard=None):
+    if output_sink:
+        output_sink = StreamDedupSink(output_sink)
+    batcher = StreamBatcher(storage_provider, media_downloader, output_sink=output_sink, lease_guard=lease_guard)
+    scheduler = ChatScheduler(storage_provider, media_downloader=media_downloader, output_sink=output_sink,
+                              lease_guard=lease_guard)
+    gap_fill_max_ids = {}
+
+    async def fill_gaps():
+        await scheduler.run(chat_ids, message_filter)
+        if not output_sink:
+            return
+        # Отправленные ID забываем с отставанием на одну дочитку: событие могло прийти уже после нее
+        for chat_id in chat_ids:
+            if chat_id in gap_fill_max_ids:
+                output_sink.forget(chat_id, gap_fill_max_ids[chat_id])
+            gap_fill_max_ids[chat_id] = (await storage_provider.get_checkpoint(chat_id))['max_id'] or 0
+
+    async def on_new_message(event):
+        # Части альбома приходят и как NewMessage, их обрабатывает on_album целиком
+        if event.message.grouped_id or not message_filter.should_process(event.message):
+            return
+        media_jobs = []
+        record = build_message_record(event.message, message_filter, media_jobs)
+        await batcher.add(event.chat_id, [record], media_jobs)
+
+    async def on_album(event):
+        media_jobs = []
+        records = await collect_album_records(event.chat_id, event.messages, message_filter, media_jobs)
+        await batcher.add(event.chat_id, records, media_jobs)
+
+    async def on_message_edited(event):
+        if event.message.grouped_id:
+            # Подпись альбома общая для всех частей, как в collect_album_records: правка переписывает текст
+            # всего альбома, а не только части с подписью
+            album = await fetch_album_parts(event.chat_id, event.message)
+            album_text = next((part.text for part in album if part.text), None) or 'No Text'
+            for part in album:
+                if message_filter.should_process(part):
+                    await batcher.add_edit(event.chat_id, MessageRecord.from_message(part, text=album_text))
+            return
+        if not message_filter.should_process(event.message):
+            return
+        await batcher.add_edit(event.chat_id, MessageRecord.from_message(event.message))
+
+    client.add_event_handler(on_new_message, events.NewMessage(chats=chat_ids))
+    client.add_event_handler(on_album, events.Album(chats=chat_ids))
+    client.add_event_handler(on_message_edited, events.MessageEdited(chats=chat_ids))
+    batcher.start()
+    logger.info("Потоковый режим: слушаем %s чатов", len(chat_ids))
+
+    # Потоковые сообщения не двигают чекпоинт: недостающее между max_id и текущим концом чата
+    # дочитывает обычная прямая выгрузка — при старте, после переподключения и периодически,
+    # так как Telethon переподключается сам и пропущенные за это время события не гарантированы
+    try:
+        await fill_gaps()
+        last_gap_fill = time.monotonic()
+        while True:
+            await asyncio.sleep(5)
+            if not client.is_connected():
+                logger.warning("Соединение с Telegram потеряно, переподключаемся...")
+                await client.connect()
+                await batcher.flush()
+                await fill_gaps()
+                last_gap_fill = time.monotonic()
+            elif time.monotonic() - last_gap_fill >= stream_gap_fill_interval:
+                await batcher.flush()
+                await fill_gaps()
+                last_gap_fill = time.monotonic()
+    finally:
+        client.remove_event_handler(on_new_message)
+        client.remove_event_handler(on_album)
+        client.remove_event_handler(on_message_edited)
+        await batcher.close()
+
+# Размер одного запроса при скачивании файла частями (максимум MTProto)
+DOWNLOAD_CHUNK_SIZE = 512 * 1024
+
+def media_store_key(media):
+    # Telegram отдает один и тот же id и access_hash для файла, сколько бы раз его ни пересылали
+    if isinstance(media, types.MessageMediaPhoto) and isinstance(media.photo, types.Photo):
+        return f"photo_{media.photo.id}_{media.photo.access_hash}"
+    if isinstance(media, types.MessageMediaDocument) and isinstance(media.document, types.Document):
+        return f"document_{media.document.id}_{media.document.access_hash}"
+    return None
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Хранилище медиа с адресацией по содержимому: файлы лежат в root/ab/cd/<sha256>.<ext>,
+# ключ Telegram (id + access_hash) и sha256 ведут к одному файлу, поэтому повторные пересылки не скачиваются
+class MediaStore:
+    INDEX_FILE = 'index.jsonl'
+    INCOMING_DIR = '.incoming'
+
+    def __init__(self, root, max_bytes=media_store_max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(root, self.INDEX_FILE)
+        self.incoming_path = os.path.join(root, self.INCOMING_DIR)
+        # sha256 -> {'path', 'size', 'last_access'}, порядок — от давно не использованных к свежим
+        self.blobs = OrderedDict()
+        self.keys = {}
+        self.total_bytes = 0
+        os.makedirs(self.incoming_path, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        # Индекс — журнал JSON-строк, при старте просто проигрываем его
+        lines = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if entry['op'] == 'blob':
+                        self.blobs[entry['sha256']] = {
+                            'path': entry['path'], 'size': entry['size'], 'last_access': entry['last_access']
+                        }
+                    elif entry['op'] == 'key':
+                        self.keys[entry['key']] = entry['sha256']
+                    elif entry['op'] == 'evict':
+                        self.blobs.pop(entry['sha256'], None)
+
+        self.blobs = OrderedDict(sorted(self.blobs.items(), key=lambda item: item[1]['last_access']))
+        self.keys = {key: sha256 for key, sha256 in self.keys.items() if sha256 in self.blobs}
+        self.total_bytes = sum(blob['size'] for blob in self.blobs.values())
+        if lines > 2 * (len(self.blobs) + len(self.keys)) + 100:
+            self._compact()
+        logger.info("Хранилище медиа: %s файлов, %.1f МБ, %s ключей",
+                    len(self.blobs), self.total_bytes / 1048576, len(self.keys))
+
+    def _compact(self):
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            for sha256, blob in self.blobs.items():
+                f.write(json.dumps({'op': 'blob', 'sha256': sha256, **blob}) + '\n')
+            for key, sha256 in self.keys.items():
+                f.write(json.dumps({'op': 'key', 'key': key, 'sha256': sha256}) + '\n')
+        os.replace(temp_path, self.index_path)
+
+    def _append(self, *entries):
+        with open(self.index_path, 'a') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+
+    def _touch(self, sha256):
+        blob = self.blobs[sha256]
+        blob['last_access'] = time.time()
+        self.blobs.move_to_end(sha256)
+        return blob
+
+    def lookup(self, key):
+        sha256 = self.keys.get(key)
+        if sha256 is None or sha256 not in self.blobs:
+            return None
+        blob = self.blobs[sha256]
+        media_path = os.path.join(self.root, blob['path'])
+        if not os.path.exists(media_path):
+            return None
+        self._touch(sha256)
+        self._append({'op': 'blob', 'sha256': sha256, **blob})
+        return media_path
+
+    async def put(self, key, downloaded_path):
+        sha256 = await asyncio.to_thread(file_sha256, downloaded_path)
+        entries = []
+        if sha256 in self.blobs and os.path.exists(os.path.join(self.root, self.blobs[sha256]['path'])):
+            # Такой файл уже есть под другим ключом, второй экземпляр не нужен
+            os.remove(downloaded_path)
+            blob = self._touch(sha256)
+        else:
+            ext = os.path.splitext(downloaded_path)[1].lower()
+            relative_path = os.path.join(sha256[:2], sha256[2:4], sha256 + ext)
+            os.makedirs(os.path.join(self.root, sha256[:2], sha256[2:4]), exist_ok=True)
+            shutil.move(downloaded_path, os.path.join(self.root, relative_path))
+            blob = {'path': relative_path, 'size': os.path.getsize(os.path.join(self.root, relative_path)),
+                    'last_access': time.time()}
+            self.blobs[sha256] = blob
+            self.total_bytes += blob['size']
+        entries.append({'op': 'blob', 'sha256': sha256, **blob})
+        if key:
+            self.keys[key] = sha256
+            entries.append({'op': 'key', 'key': key, 'sha256': sha256})
+        self._append(*entries)
+        self._evict(keep=sha256)
+        return os.path.join(self.root, blob['path'])
+
+    def _evict(self, keep):
+        # LRU по суммарному размеру; только что добавленный файл не вытесняем
+        if not self.max_bytes:
+            return
+        while self.total_bytes > self.max_bytes and len(self.blobs) > 1:
+            sha256 = next(iter(self.blobs))
+            if sha256 == keep:
+                self.blobs.move_to_end(sha256)
+                continue
+            blob = self.blobs.pop(sha256)
+            self.total_bytes -= blob['size']
+            try:
+                os.remove(os.path.join(self.root, blob['path']))
+            except FileNotFoundError:
+                pass
+            self._append({'op': 'evict', 'sha256': sha256})
+            logger.debug("Медиафайл %s вытеснен из хранилища", blob['path'])
+
+# Отдельная стадия скачивания медиа: очередь задач и ограниченный пул воркеров
+class MediaDownloader:
+    def __init__(self, storage_provider, message_filter, workers=media_workers, queue_size=media_queue_size,
+                 max_file_size=media_max_file_size, retries=media_retries,
+                 parallel_threshold=media_parallel_threshold, parallel_parts=media_parallel_parts, media_store=None):
+        self.storage_provider = storage_provider
+        self.message_filter = message_filter
+        self.workers = workers
+        self.max_file_size = max_file_size
+        self.retries = retries
+        self.parallel_threshold = parallel_threshold
+        self.parallel_parts = parallel_parts
+        self.media_store = media_store
+        # Ограниченная очередь: когда воркеры не успевают, submit ждет и притормаживает парсинг
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.in_progress = 0
+        self.downloaded = 0
+        self.deduplicated = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes_downloaded = 0
+        self.started_at = None
+        self._tasks = []
+        # Задачи в очереди и в работе: одно сообщение не ставится дважды (например, событием и при докачке)
+        self._queued = set()
+        self._recovered = set()
+
+    @property
+    def target_path(self):
+        # С хранилищем файл сначала качается во временную папку, а потом переносится по sha256
+        return self.media_store.incoming_path if self.media_store else download_media_path
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._report_loop()))
+
+    async def submit(self, chat_id, message):
+        if (chat_id, message.id) in self._queued:
+            return
+        self._queued.add((chat_id, message.id))
+        await self.queue.put((chat_id, message))
+
+    async def recover(self, chat_id):
+        # Медиа, которое не докачали прошлые запуски (упали или исчерпали MEDIA_RETRIES), ставим в очередь
+        # заново, один раз за процесс на чат
+        if chat_id in self._recovered:
+            return
+        message_ids = await self.storage_provider.get_pending_media(chat_id)
+        for start in range(0, len(message_ids), 100):
+            ids = message_ids[start:start + 100]
+            for message_id, message in zip(ids, await client.get_messages(chat_id, ids=ids)):
+                if message is None or not message.media:
+                    # Сообщение удалено или медиа убрали правкой: скачивать больше нечего
+                    await self.storage_provider.set_media_status(chat_id, message_id, 'missing')
                 else:
-                    print(f"Не удалось скачать медиа для сообщения {message.id}")
-                if media_path and not is_valid_media_extension(media_path, filters):
-                    print(f"Медиафайл {media_path} удален: неподдерживаемое расширение")
-                    os.remove(media_path)
-                    media_path = None
-
-            sender_id = str(message.sender_id) if message.sender_id else 'None'
-            message_entry = f"{message.id}|{message.date}|{sender_id}|{text}|{media_path}"
-            print(f"Сообщение прошло фильтр: {message_entry}")
-            new_messages.append(message_entry)
-
-        if len(new_messages) >= batch_size:
-            await storage_provider.save_messages(new_messages, chat_id)
-            new_messages = []
-
-        last_fetched_id = message.id
-
-    if new_messages:
-        await storage_provider.save_messages(new_messages, chat_id)
+                    await self.submit(chat_id, message)
+        self._recovered.add(chat_id)
+        if message_ids:
+            logger.info("Чат %s: поставлено на докачку медиа %s сообщений", chat_id, len(message_ids))
+
+    async def close(self):
+        await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("Скачивание медиа завершено: %s", self.format_stats())
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        return {
+            'queue_depth': self.queue.qsize(),
+            'in_progress': self.in_progress,
+            'downloaded': self.downloaded,
+            'deduplicated': self.deduplicated,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'bytes': self.bytes_downloaded,
+            'bytes_per_second': self.bytes_downloaded / elapsed if elapsed else 0.0,
+            'bytes_saved': self.message_filter.saved_bytes
+        }
 
-    if last_fetched_id:
-        await storage_provider.save_last_message_id(chat_id, last_fetched_id)
+    def format_stats(self):
+        stats = self.stats()
+        return (f"в очереди {stats['queue_depth']}, качается {stats['in_progress']}, скачано {stats['downloaded']}, "
+                f"уже было в хранилище {stats['deduplicated']}, "
+                f"пропущено {stats['skipped']}, ошибок {stats['failed']}, "
+                f"{stats['bytes'] / 1048576:.1f} МБ, {stats['bytes_per_second'] / 1048576:.2f} МБ/с, "
+                f"не скачано по расширению {stats['bytes_saved'] / 1048576:.1f} МБ")
+
+    async def _report_loop(self, interval=30):
+        while True:
+            await asyncio.sleep(interval)
+            if self.queue.qsize() or self.in_progress:
+                logger.info("Медиа: %s", self.format_stats())
+
+    async def _worker(self):
+        while True:
+            chat_id, message = await self.queue.get()
+            self.in_progress += 1
+            try:
+                await self._process(chat_id, message)
+            except Exception as e:
+                self.failed += 1
+                MEDIA_RESULTS.inc(result='failed')
+                logger.error("Ошибка при обработке медиа сообщения %s из чата %s: %s", message.id, chat_id, e)
+                await self._set_status(chat_id, message.id, 'failed')
+            finally:
+                self._queued.discard((chat_id, message.id))
+                self.in_progress -= 1
+                self.queue.task_done()
+
+    async def _set_status(self, chat_id, message_id, media_status):
+        try:
+            await self.storage_provider.set_media_status(chat_id, message_id, media_status)
+        except Exception as e:
+            logger.error("Не удалось записать media_status сообщения %s из чата %s: %s", message_id, chat_id, e)
+
+    async def _process(self, chat_id, message):
+        size = message.file.size if message.file else None
+        if self.max_file_size and size and size > self.max_file_size:
+            self.skipped += 1
+            MEDIA_RESULTS.inc(result='skipped')
+            logger.warning("Медиа сообщения %s пропущено: размер %s больше MEDIA_MAX_FILE_SIZE", message.id, size)
+            await self._set_status(chat_id, message.id, 'skipped')
+            return
+
+        key = media_store_key(message.media)
+        if self.media_store and key:
+            media_path = self.media_store.lookup(key)
+            if media_path:
+                self.deduplicated += 1
+                MEDIA_RESULTS.inc(result='deduplicated')
+                await self.storage_provider.update_media_path(chat_id, message.id, media_path)
+                return
+
+        media_path = None
+        for attempt in range(1, self.retries + 1):
+            try:
+                with MEDIA_DOWNLOAD_SECONDS.time():
+                    media_path = await self._download(chat_id, message, size)
+                break
+            except FloodWaitError as e:
+                FLOOD_WAITS.inc(source='media')
+                FLOOD_WAIT_SECONDS.inc(e.seconds, source='media')
+                await asyncio.sleep(e.seconds)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning("Ошибка скачивания медиа сообщения %s (попытка %s): %s", message.id, attempt, e)
+                await asyncio.sleep(2 ** attempt)
+
+        if not media_path:
+            self.failed += 1
+            MEDIA_RESULTS.inc(result='failed')
+            logger.warning("Не удалось скачать медиа для сообщения %s", message.id)
+            await self._set_status(chat_id, message.id, 'failed')
+            return
+        # Расширение уже проверено до скачивания, здесь страховка на случай, если Telethon выбрал другое имя
+        if not is_valid_media_extension(media_path, self.message_filter.filters):
+            logger.warning("Медиафайл %s удален: неподдерживаемое расширение", media_path)
+            os.remove(media_path)
+            self.skipped += 1
+            MEDIA_RESULTS.inc(result='skipped')
+            await self._set_status(chat_id, message.id, 'skipped')
+            return
+
+        size = os.path.getsize(media_path)
+        self.downloaded += 1
+        self.bytes_downloaded += size
+        MEDIA_RESULTS.inc(result='downloaded')
+        MEDIA_BYTES.inc(size)
+        if self.media_store:
+            media_path = await self.media_store.put(key, media_path)
+        logger.debug("Скачан медиафайл: %s", media_path)
+        await self.storage_provider.update_media_path(chat_id, message.id, media_path)
+
+    async def _download(self, chat_id, message, size):
+        if (isinstance(message.media, types.MessageMediaDocument) and size
+                and size >= self.parallel_threshold and self.parallel_parts > 1):
+            return await self._download_parallel(chat_id, message, size)
+        return await message.download_media(file=self.target_path)
+
+    async def _download_parallel(self, chat_id, message, size):
+        # Большой документ качаем несколькими диапазонами одновременно через iter_download.
+        # ID сообщений повторяются в разных чатах, поэтому в имени есть chat_id; имя от отправителя без путей
+        prefix = f"{chat_id}_{message.id}"
+        base_name = os.path.basename(message.file.name) if message.file.name else ''
+        file_name = f"{prefix}_{base_name}" if base_name else f"{prefix}{message.file.ext or ''}"
+        media_path = os.path.join(self.target_path, file_name)
+        chunk_count = (size + DOWNLOAD_CHUNK_SIZE - 1) // DOWNLOAD_CHUNK_SIZE
+        chunks_per_part = (chunk_count + self.parallel_parts - 1) // self.parallel_parts
+
+        with open(media_path, 'wb') as f:
+            f.truncate(size)
+
+        async def download_part(first_chunk):
+            offset = first_chunk * DOWNLOAD_CHUNK_SIZE
+            with open(media_path, 'r+b') as f:
+                f.seek(offset)
+                async for chunk in client.iter_download(message.media, offset=offset, limit=chunks_per_part,
+                                                        request_size=DOWNLOAD_CHUNK_SIZE, file_size=size):
+                    f.write(chunk)
 
-# Функции фильтрации
-def should_download_media(message, filters):
-    if not message.media:
+        try:
+            await asyncio.gather(*(download_part(first_chunk) for first_chunk in range(0, chunk_count, chunks_per_part)))
+        except BaseException:
+            os.remove(media_path)
+            raise
+        return media_path
+
+# Прогресс парсинга одного чата за запуск
+class ChatProgress:
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.status = 'pending'
+        self.messages = 0
+        self.attempts = 0
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def throughput(self):
+        return self.messages / self.elapsed if self.elapsed else 0.0
+
+def chat_dc_id(chat):
+    # Telegram не сообщает DC чата напрямую, ближайший признак — DC его аватарки
+    photo = getattr(chat, 'photo', None)
+    return getattr(photo, 'dc_id', None) or client.session.dc_id
+
+# Планировщик: парсит несколько чатов одновременно с ограничениями на общее число, DC и чат
+class ChatScheduler:
+    def __init__(self, storage_provider, max_concurrency=parser_concurrency, per_dc_limit=parser_per_dc_concurrency,
+                 per_chat_limit=parser_per_chat_concurrency, max_retries=parser_max_retries, media_downloader=None,
+                 backfill=backfill_enabled, output_sink=None, flood_budget=0, lease_guard=None):
+        self.storage_provider = storage_provider
+        self.max_concurrency = max_concurrency
+        self.per_dc_limit = per_dc_limit
+        self.per_chat_limit = per_chat_limit
+        self.max_retries = max_retries
+        self.media_downloader = media_downloader
+        self.output_sink = output_sink
+        # Проверка аренды перед записью каждой пачки (при шардировании)
+        self.lease_guard = lease_guard
+        # Обратная выгрузка идет первой: для нового чата она сразу задает верхнюю границу для прямой
+        self.directions = ('backward', 'forward') if backfill else ('forward',)
+        self.progress = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._dc_semaphores = {}
+        self._chat_semaphores = {}
+        self._paused_until = 0.0
+        self._backoff = 1.0
+        # Сколько секунд FloodWait аккаунт может набрать за запуск, прежде чем воркер отдаст чаты другим (0 — без лимита)
+        self.flood_budget = flood_budget
+        self.flood_wait_total = 0.0
+
+    @property
+    def flood_budget_exhausted(self):
+        return bool(self.flood_budget) and self.flood_wait_total > self.flood_budget
+
+    def _dc_semaphore(self, dc_id):
+        if dc_id not in self._dc_semaphores:
+            self._dc_semaphores[dc_id] = asyncio.Semaphore(self.per_dc_limit)
+        return self._dc_semaphores[dc_id]
+
+    def _chat_semaphore(self, chat_id):
+        if chat_id not in self._chat_semaphores:
+            self._chat_semaphores[chat_id] = asyncio.Semaphore(self.per_chat_limit)
+        return self._chat_semaphores[chat_id]
+
+    async def _wait_resume(self):
+        loop = asyncio.get_running_loop()
+        while loop.time() < self._paused_until:
+            await asyncio.sleep(self._paused_until - loop.time())
+
+    async def _flood_wait(self, seconds):
+        # FloodWait действует на весь аккаунт, поэтому останавливаем запуск запросов во всех задачах,
+        # а при повторных FloodWait подряд увеличиваем паузу
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        FLOOD_WAITS.inc(source='messages')
+        if now < self._paused_until:
+            # Эту же ошибку получают все запросы, запущенные до паузы: ее не увеличиваем, а ждем вместе со всеми.
+            # Продлеваем, только если Telegram просит ждать дольше, чем осталось
+            self._extend_pause(now, seconds)
+            await self._wait_resume()
+            return
+        delay = seconds * self._backoff
+        self._backoff = min(self._backoff * 1.5, 4.0)
+        # Паузы нет, поэтому вся задержка — новое время простоя аккаунта
+        self.flood_wait_total += delay
+        FLOOD_WAIT_SECONDS.inc(delay, source='messages')
+        if self.flood_budget_exhausted:
+            logger.warning("FloodWait на %s с: бюджет %s с исчерпан, новые запросы не запускаем", seconds, self.flood_budget)
+            return
+        self._paused_until = now + delay
+        logger.warning("FloodWait на %s с, приостанавливаем запросы на %.0f с", seconds, delay)
+        await self._wait_resume()
+
+    def _extend_pause(self, now, delay):
+        # В бюджет и метрики идет только добавленное к паузе время, а не запрошенное каждой задачей
+        added = max(0.0, now + delay - self._paused_until)
+        self._paused_until += added
+        self.flood_wait_total += added
+        FLOOD_WAIT_SECONDS.inc(added, source='messages')
+
+    async def _run_chat(self, chat_id, message_filter):
+        progress = self.progress[chat_id]
+        progress.status = 'running'
+        progress.started_at = time.monotonic()
+        # Прямая и обратная выгрузки одного чата — отдельные задачи, одновременно их пускает per_chat_limit.
+        # Параллельно они безопасны, только когда у чата уже есть диапазон: тогда каждая двигает свою границу.
+        # У нового чата обе выгрузки записали бы в чекпоинт концы истории ([1, самое новое]), пока середина
+        # еще не выгружена, поэтому до появления диапазона направления идут по очереди
+        checkpoint = await self.storage_provider.get_checkpoint(chat_id)
+        if len(self.directions) > 1 and not (checkpoint['max_id'] and checkpoint['min_id']):
+            for direction in self.directions:
+                await self._run_direction(progress, message_filter, direction)
+                if progress.status == 'lost':
+                    break
+        else:
+            await asyncio.gather(*(self._run_direction(progress, message_filter, direction)
+                                   for direction in self.directions))
+        if progress.status == 'running':
+            progress.status = 'done'
+        progress.finished_at = time.monotonic()
+
+    async def _run_direction(self, progress, message_filter, direction):
+        chat_id = progress.chat_id
+        async with self._chat_semaphore(chat_id), self._semaphore:
+            for attempt in range(1, self.max_retries + 2):
+                if self.flood_budget_exhausted:
+                    progress.status = 'failed'
+                    progress.error = "FloodWait: исчерпан бюджет аккаунта"
+                    return
+                await self._wait_resume()
+                progress.attempts += 1
+                try:
+                    chat = await client.get_entity(chat_id)
+                    async with self._dc_semaphore(chat_dc_id(chat)):
+                        if self.media_downloader:
+                            await self.media_downloader.recover(chat_id)
+                        logger.info("Парсим чат: %s (%s)", chat_id, direction)
+                        progress.messages += await fetch_chat_messages(
+                            self.storage_provider, chat_id, message_filter, chat=chat,
+                            media_downloader=self.media_downloader, direction=direction,
+                            output_sink=self.output_sink, lease_guard=self.lease_guard
+                        )
+                    self._backoff = max(1.0, self._backoff / 1.5)
+                    return
+                except FloodWaitError as e:
+                    progress.flood_waits += 1
+                    progress.flood_wait_seconds += e.seconds
+                    await self._flood_wait(e.seconds)
+                except LeaseLostError as e:
+                    # Чат забрал другой воркер: останавливаем выгрузку, уже записанное осталось под чекпоинтом
+                    progress.status = 'lost'
+                    progress.error = str(e)
+                    logger.warning("Выгрузка чата %s (%s) остановлена: %s", chat_id, direction, e)
+                    return
+                except Exception as e:
+                    # Ошибка одного чата не должна останавливать весь запуск
+                    progress.status = 'failed'
+                    progress.error = repr(e)
+                    logger.error("Ошибка при парсинге чата %s (%s): %s", chat_id, direction, e)
+                    return
+            progress.status = 'failed'
+            progress.error = f"FloodWait: исчерпано {self.max_retries} повторов"
+
+    async def run(self, chat_ids, message_filter):
+        self.progress = {chat_id: ChatProgress(chat_id) for chat_id in chat_ids}
+        started = time.monotonic()
+        await asyncio.gather(*(self._run_chat(chat_id, message_filter) for chat_id in self.progress))
+        self.print_summary(time.monotonic() - started)
+        return self.progress
+
+    def print_summary(self, elapsed):
+        logger.info("Итоги парсинга по чатам:")
+        for progress in self.progress.values():
+            line = (f"  {progress.chat_id}: {progress.status}, сообщений {progress.messages}, "
+                    f"{progress.elapsed:.1f} с, {progress.throughput:.1f} сообщ./с")
+            if progress.flood_waits:
+                line += f", FloodWait {progress.flood_waits} раз ({progress.flood_wait_seconds} с)"
+            if progress.error:
+                line += f", ошибка: {progress.error}"
+            logger.info("%s", line)
+        total = sum(progress.messages for progress in self.progress.values())
+        failed = sum(1 for progress in self.progress.values() if progress.status == 'failed')
+        rate = total / elapsed if elapsed else 0.0
+        logger.info("Всего: %s чатов (%s с ошибкой), %s сообщений за %.1f с, %.1f сообщ./с",
+                    len(self.progress), failed, total, elapsed, rate)
+
+# Шардирование по нескольким аккаунтам: каждый воркер — отдельный процесс со своей сессией.
+# Чат достается воркеру по rendezvous-хешированию среди живых воркеров: при уходе или появлении воркера
+# переезжают только его чаты. Аренда чата в MongoDB гарантирует, что один чат не выгружают двое сразу
+def shard_owner(chat_id, workers):
+    return max(workers, key=lambda worker_id: hashlib.blake2b(f"{worker_id}:{chat_id}".encode(), digest_size=8).digest())
+
+class ShardCoordinator:
+    def __init__(self, storage_provider, worker_id, lease_ttl=shard_lease_ttl, heartbeat_interval=shard_heartbeat_interval,
+                 run_started=shard_run_started):
+        self.storage_provider = storage_provider
+        self.worker_id = worker_id
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = heartbeat_interval
+        # Начало общего запуска: чаты, завершенные раньше, в этом запуске выгружаются заново
+        self.run_started = run_started or time.time()
+        self.owned = set()
+        # Срок аренды по данным этого воркера и чаты, потерянные с последней перебалансировки
+        self.expires = {}
+        self.lost = set()
+        self._heartbeat_task = None
+
+    async def start(self):
+        await self.storage_provider.save_worker_heartbeat(self.worker_id, time.time())
+        self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+        logger.info("Воркер %s запущен", self.worker_id)
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                now = time.time()
+                await self.storage_provider.save_worker_heartbeat(self.worker_id, now)
+                for chat_id in list(self.owned):
+                    await self._renew(chat_id, now)
+            except Exception as e:
+                logger.error("Ошибка heartbeat воркера %s: %s", self.worker_id, e)
+
+    async def _renew(self, chat_id, now):
+        if await self.storage_provider.acquire_lease(chat_id, self.worker_id, now, now + self.lease_ttl):
+            self.expires[chat_id] = now + self.lease_ttl
+            return True
+        # Аренда истекла и ее забрал другой воркер: этот чат больше не наш
+        if chat_id in self.owned:
+            self.owned.discard(chat_id)
+            self.lost.add(chat_id)
+            logger.warning("Воркер %s потерял аренду чата %s", self.worker_id, chat_id)
         return False
 
-    if filters["filter_hashtags"] and message.text:
-        if not any(hashtag in message.text for hashtag in filters["filter_hashtags"]):
+    async def holds(self, chat_id):
+        # Вызывается перед записью каждой пачки. Если до конца аренды меньше интервала heartbeat
+        # (heartbeat отстал или MongoDB была недоступна), продлеваем ее сами и без нее не пишем
+        if chat_id not in self.owned:
             return False
+        now = time.time()
+        if self.expires.get(chat_id, 0) - now > self.heartbeat_interval:
+            return True
+        return await self._renew(chat_id, now)
+
+    async def assigned(self, chat_ids):
+        workers = await self.storage_provider.get_live_workers(time.time() - self.lease_ttl)
+        if self.worker_id not in workers:
+            workers.append(self.worker_id)
+        return [chat_id for chat_id in chat_ids if shard_owner(chat_id, workers) == self.worker_id]
+
+    async def claim(self, chat_ids):
+        now = time.time()
+        claimed = []
+        for chat_id in await self.assigned(chat_ids):
+            if await self.storage_provider.acquire_lease(chat_id, self.worker_id, now, now + self.lease_ttl):
+                self.owned.add(chat_id)
+                self.expires[chat_id] = now + self.lease_ttl
+                claimed.append(chat_id)
+        return claimed
+
+    async def release(self, chat_ids, finished=False):
+        finished_at = time.time() if finished else None
+        for chat_id in chat_ids:
+            await self.storage_provider.release_lease(chat_id, self.worker_id, finished_at)
+            self.owned.discard(chat_id)
+            self.expires.pop(chat_id, None)
+
+    async def rebalance(self, chat_ids):
+        # Для потокового режима: забираем свои чаты и отдаем те, что по хешу перешли к другим воркерам.
+        # Потерянная между вызовами аренда тоже меняет состав: поток все еще слушает этот чат
+        before = set(self.owned)
+        assigned = set(await self.claim(chat_ids))
+        await self.release(self.owned - assigned)
+        lost, self.lost = self.lost, set()
+        return self.owned != before or bool(lost - self.owned)
+
+    async def close(self):
+        # Дожидаемся отмены heartbeat: иначе его запись может попасть в базу после remove_worker,
+        # и воркер до SHARD_LEASE_TTL будет считаться живым
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+        await self.release(list(self.owned))
+        await self.storage_provider.remove_worker(self.worker_id)
+        logger.info("Воркер %s остановлен", self.worker_id)
+
+# Общее пространство ID сообщений есть только у каналов и супергрупп. В личных чатах и обычных группах ID
+# у каждого аккаунта свои, а чекпоинт и дедупликация общие, поэтому такие чаты между воркерами не переезжают
+def is_channel_id(chat_id):
+    return utils.resolve_id(chat_id)[1] is types.PeerChannel
+
+async def run_sharded(chat_ids, message_filter, storage_provider, media_downloader=None, output_sink=None):
+    # Не-каналы всегда выгружает основной воркер SHARD_PRIMARY, без аренд и перебалансировки
+    pinned = [chat_id for chat_id in chat_ids if not is_channel_id(chat_id)]
+    chat_ids = [chat_id for chat_id in chat_ids if is_channel_id(chat_id)]
+    if pinned and shard_worker_id != shard_primary:
+        if shard_primary:
+            logger.info("Личные чаты и группы (%s) выгружает основной воркер %s", len(pinned), shard_primary)
+        else:
+            logger.warning("SHARD_PRIMARY не задан: личные чаты и группы (%s) пропускаются", len(pinned))
+        pinned = []
+
+    coordinator = ShardCoordinator(storage_provider, shard_worker_id)
+    pinned_ids = set(pinned)
+
+    # Закрепленные чаты пишутся без аренды, остальные — только пока аренда у этого воркера
+    async def lease_guard(chat_id):
+        return chat_id in pinned_ids or await coordinator.holds(chat_id)
+
+    await coordinator.start()
+    try:
+        if stream_mode:
+            await run_sharded_stream(coordinator, chat_ids, message_filter, storage_provider, media_downloader, output_sink,
+                                     pinned, lease_guard)
+            return
+        scheduler = ChatScheduler(storage_provider, media_downloader=media_downloader, output_sink=output_sink,
+                                  flood_budget=shard_flood_budget, lease_guard=lease_guard)
+        if pinned:
+            await scheduler.run(pinned, message_filter)
+        while True:
+            finished = await storage_provider.get_finished_chats(chat_ids, coordinator.run_started)
+            pending = [chat_id for chat_id in chat_ids if chat_id not in finished]
+            if not pending:
+                break
+            claimed = await coordinator.claim(pending)
+            if not claimed:
+                # Оставшиеся чаты у других воркеров или под арендой упавшего: ждем, пока она истечет
+                await asyncio.sleep(coordinator.heartbeat_interval)
+                continue
+            progress = await scheduler.run(claimed, message_filter)
+            if scheduler.flood_budget_exhausted:
+                # Невыгруженные чаты отдаем без отметки о завершении, их заберут другие воркеры
+                await coordinator.release([chat_id for chat_id in claimed if progress[chat_id].status == 'done'],
+                                          finished=True)
+                logger.warning("Воркер %s исчерпал бюджет FloodWait и отдает чаты", coordinator.worker_id)
+                break
+            # Чат с потерянной арендой доделывает новый владелец, он и отметит завершение
+            await coordinator.release([chat_id for chat_id in claimed if progress[chat_id].status != 'lost'], finished=True)
+    finally:
+        await coordinator.close()
+
+async def run_sharded_stream(coordinator, chat_ids, message_filter, storage_provider, media_downloader=None,
+                             output_sink=None, pinned=(), lease_guard=None):
+    while True:
+        await coordinator.rebalance(chat_ids)
+        owned = sorted(coordinator.owned | set(pinned))
+        if not owned:
+            await asyncio.sleep(coordinator.heartbeat_interval)
+            continue
+        logger.info("Воркер %s слушает %s чатов", coordinator.worker_id, len(owned))
+        stream_task = asyncio.create_task(run_stream(owned, message_filter, storage_provider, media_downloader, output_sink,
+                                                     lease_guard))
+        try:
+            while not stream_task.done():
+                await asyncio.sleep(coordinator.heartbeat_interval)
+                if await coordinator.rebalance(chat_ids):
+                    logger.info("Воркер %s: состав чатов изменился, перезапускаем поток", coordinator.worker_id)
+                    break
+        finally:
+            stream_task.cancel()
+            await asyncio.gather(stream_task, return_exceptions=True)
+        if stream_task.done() and not stream_task.cancelled() and stream_task.exception():
+            raise stream_task.exception()
+
+# Супервизор: по процессу-воркеру на каждую сессию из SHARD_SESSIONS, упавший воркер перезапускается.
+# Пока его нет, его чаты после истечения heartbeat переходят к остальным
+async def run_supervisor(sessions=shard_sessions, max_restarts=shard_max_restarts):
+    run_started = str(time.time())
+
+    async def supervise(session):
+        env = dict(os.environ, SESSION_NAME=session, SHARD_WORKER_ID=session, SHARD_SESSIONS='',
+                   SHARD_RUN_STARTED=run_started, SHARD_PRIMARY=shard_primary or sessions[0])
+        for attempt in range(max_restarts + 1):
+            process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+            returncode = await process.wait()
+            if returncode == 0:
+                return 0
+            logger.error("Воркер %s завершился с кодом %s (попытка %s)", session, returncode, attempt + 1)
+            await asyncio.sleep(shard_heartbeat_interval)
+        return returncode
+
+    logger.info("Запускаем %s воркеров: %s", len(sessions), ', '.join(sessions))
+    results = await asyncio.gather(*(supervise(session) for session in sessions))
+    return max(results)
 
-    if filters["filter_keywords"] and message.text:
-        if not any(keyword.lower() in message.text.lower() for keyword in filters["filter_keywords"]):
-            return False
-
-    if not filters["filter_message_types"]:
-        return filters["filter_max_file_size"] == 0 or message.media.document.size <= filters["filter_max_file_size"] if isinstance(message.media, types.MessageMediaDocument) else True
-
-    if "photo" in filters["filter_message_types"] and isinstance(message.media, types.MessageMediaPhoto):
-        if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
-            return False
+# Функции фильтрации
+PHOTO_EXTENSIONS = ('jpg', 'jpeg', 'png', 'gif')
+VIDEO_EXTENSIONS = ('mp4', 'mov', 'avi')
+DOCUMENT_EXTENSIONS = ('pdf', 'doc', 'docx', 'txt')
+MEDIA_EXTENSIONS = {
+    "photo": PHOTO_EXTENSIONS,
+    "video": VIDEO_EXTENSIONS,
+    "document": DOCUMENT_EXTENSIONS
+}
+
+def media_file_info(media):
+    # Имя файла, mime_type и размер известны до скачивания
+    if isinstance(media, types.MessageMediaPhoto):
+        return 'photo.jpg', 'image/jpeg', None
+    if isinstance(media, types.MessageMediaDocument) and media.document:
+        document = media.document
+        file_name = next((attribute.file_name for attribute in getattr(document, 'attributes', [])
+                          if isinstance(attribute, types.DocumentAttributeFilename)), None)
+        return file_name, getattr(document, 'mime_type', None), getattr(document, 'size', None)
+    return None, None, None
+
+# Единая классификация медиа по расширению: и до скачивания, и для уже сохраненного файла
+def classify_media(message_types, file_name=None, mime_type=None):
+    if not message_types:
         return True
-
-    if "video" in filters["filter_message_types"] and isinstance(message.media, types.MessageMediaDocument) and message.media.document.mime_type.startswith('video'):
-        if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
-            return False
-        return filters["filter_max_file_size"] == 0 or message.media.document.size <= filters["filter_max_file_size"]
-
-    if "document" in filters["filter_message_types"] and isinstance(message.media, types.MessageMediaDocument) and not message.media.document.mime_type.startswith('video'):
-        if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
-            return False
-        return filters["filter_max_file_size"] == 0 or message.media.document.size <= filters["filter_max_file_size"]
-
-    if isinstance(message.media, types.MessageMediaPhoto):
-        for ext in filters["filter_message_types"]:
-            if ext in ["jpg", "jpeg", "png", "gif"] and ext in message.media.photo.mime_type.lower():
-                if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
-                    return False
-                return True
-    elif isinstance(message.media, types.MessageMediaDocument):
-        for ext in filters["filter_message_types"]:
-            if message.media.document.mime_type.startswith('video') and ext in ["mp4", "mov", "avi"]:
-                if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
-                    return False
-                return filters["filter_max_file_size"] == 0 or message.media.document.size <= filters["filter_max_file_size"]
-            if not message.media.document.mime_type.startswith('video') and ext in ["pdf", "doc", "docx", "txt"]:
-                if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
-                    return False
-                return filters["filter_max_file_size"] == 0 or message.media.document.size <= filters["filter_max_file_size"]
-
+    ext = os.path.splitext(file_name)[1][1:].lower() if file_name else ''
+    if not ext and mime_type:
+        ext = (mimetypes.guess_extension(mime_type) or '')[1:]
+    for kind, extensions in MEDIA_EXTENSIONS.items():
+        if ext in extensions:
+            return ext in message_types or kind in message_types
     return False
 
 def is_valid_media_extension(media_path, filters):
     if not media_path:
         return True
-
-    if not filters["filter_message_types"]:
-        return True
-
-    for ext in filters["filter_message_types"]:
-        if ext in ["jpg", "jpeg", "png", "gif", "mp4", "mov", "avi", "pdf", "doc", "docx", "txt"] and media_path.endswith(ext):
+    return classify_media(filters["filter_message_types"], file_name=media_path)
+
+def compile_any_pattern(words):
+    # Одно регулярное выражение на весь список вместо проверки каждого слова по очереди
+    if not words:
+        return None
+    return re.compile('|'.join(re.escape(word) for word in sorted(words, key=len, reverse=True)))
+
+# Фильтры из filters.json, один раз скомпилированные в предикат
+class MessageFilter:
+    def __init__(self, filters):
+        self.filters = filters
+        message_types = frozenset(filters["filter_message_types"])
+        self.enabled = bool(message_types)
+        self.accept_text = "text" in message_types
+        # Фото в Telegram всегда хранятся как jpeg, поэтому из расширений фото подходят только jpg/jpeg
+        self.accept_photo = "photo" in message_types or bool(message_types & {"jpg", "jpeg"})
+        self.accept_video = "video" in message_types or bool(message_types & set(VIDEO_EXTENSIONS))
+        self.accept_document = "document" in message_types or bool(message_types & set(DOCUMENT_EXTENSIONS))
+        self.hashtag_pattern = compile_any_pattern(filters["filter_hashtags"])
+        self.keyword_pattern = compile_any_pattern([keyword.lower() for keyword in filters["filter_keywords"]])
+        self.text_required = bool(filters["filter_hashtags"] or filters["filter_keywords"])
+        self.sender_ids = frozenset(filters["filter_sender_ids"])
+        self.date_from = int(filters["filter_date_from"].timestamp()) if filters["filter_date_from"] else None
+        self.date_to = int(filters["filter_date_to"].timestamp()) if filters["filter_date_to"] else None
+        self.max_file_size = filters["filter_max_file_size"]
+        # Сколько медиа отклонено по расширению до скачивания и сколько байт на этом сэкономлено
+        self.skipped_media = 0
+        self.saved_bytes = 0
+
+    # Хэштеги и ключевые слова проверяются одинаково для обработки и для скачивания медиа
+    def matches_text(self, text):
+        if not text:
             return True
-
-    if "photo" in filters["filter_message_types"] and media_path.endswith(("jpg", "jpeg", "png", "gif")):
-        return True
-    if "video" in filters["filter_message_types"] and media_path.endswith(("mp4", "mov", "avi")):
-        return True
-    if "document" in filters["filter_message_types"] and media_path.endswith(("pdf", "doc", "docx", "txt")):
+        if self.hashtag_pattern and not self.hashtag_pattern.search(text):
+            return False
+        if self.keyword_pattern and not self.keyword_pattern.search(text.lower()):
+            return False
         return True
 
-    return False
-
-def should_process_message(message, filters):
-    if not filters["filter_message_types"]:
-        return True
+    @staticmethod
+    def media_kind(media):
+        if isinstance(media, types.MessageMediaPhoto):
+            return "photo"
+        if isinstance(media, types.MessageMediaDocument) and media.document:
+            return "video" if (getattr(media.document, 'mime_type', None) or '').startswith('video') else "document"
+        return None
+
+    def accepts_kind(self, kind):
+        if kind == "photo":
+            return self.accept_photo
+        if kind == "video":
+            return self.accept_video
+        if kind == "document":
+            return self.accept_document
+        return False
 
-    # Логируем дату сообщения
-    print(f"Дата сообщения (message.date, UTC): {message.date}")
-    # Преобразуем дату сообщения в местное время (Europe/Moscow) для удобства
-    local_tz = pytz.timezone('Europe/Moscow')  # Можно заменить на local_tz из load_filters
-    message_date_local = message.date.astimezone(local_tz)
-    print(f"Дата сообщения (местное время, {local_tz}): {message_date_local}")
-
-    if filters["filter_date_from"]:
-        message_date = message.date.replace(microsecond=0)
-        filter_date_from = filters["filter_date_from"].replace(microsecond=0)
-        print(f"Сравнение с filter_date_from: message_date={message_date}, filter_date_from={filter_date_from}")
-        if message_date < filter_date_from:
-            print(f"Сообщение отфильтровано: дата {message_date} раньше filter_date_from {filter_date_from}")
-            return False
+    def size_ok(self, media):
+        return self.max_file_size == 0 or media.document.size <= self.max_file_size
 
-    if filters["filter_date_to"]:
-        message_date = message.date.replace(microsecond=0)
-        filter_date_to = filters["filter_date_to"].replace(microsecond=0)
-        print(f"Сравнение с filter_date_to: message_date={message_date}, filter_date_to={filter_date_to}")
-        if message_date > filter_date_to:
-            print(f"Сообщение отфильтровано: дата {message_date} позже filter_date_to {filter_date_to}")
-            return False
+    def should_process(self, message):
+        if not self.enabled:
+            return True
 
-    if filters["filter_sender_ids"] and message.sender_id not in filters["filter_sender_ids"]:
-        print(f"Сообщение отфильтровано: sender_id {message.sender_id} не в filter_sender_ids")
-        return False
+        if self.date_from is not None or self.date_to is not None:
+            timestamp = int(message.date.timestamp())
+            if self.date_from is not None and timestamp < self.date_from:
+                return False
+            if self.date_to is not None and timestamp > self.date_to:
+                return False
 
-    if filters["filter_hashtags"] and message.text:
-        if not any(hashtag in message.text for hashtag in filters["filter_hashtags"]):
-            print(f"Сообщение отфильтровано: нет хэштегов {filters['filter_hashtags']} в тексте")
+        if self.sender_ids and message.sender_id not in self.sender_ids:
             return False
 
-    if filters["filter_keywords"] and message.text:
-        if not any(keyword.lower() in message.text.lower() for keyword in filters["filter_keywords"]):
-            print(f"Сообщение отфильтровано: нет ключевых слов {filters['filter_keywords']} в тексте")
+        text = message.text
+        if not self.matches_text(text):
             return False
 
-    if "text" in filters["filter_message_types"] and message.text:
-        return True
+        if self.accept_text and text:
+            return True
 
-    if "photo" in filters["filter_message_types"] and isinstance(message.media, types.MessageMediaPhoto):
-        if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
-            print("Сообщение отфильтровано: фото без текста, но есть фильтры по хэштегам или ключевым словам")
+        if not self.accepts_kind(self.media_kind(message.media)):
             return False
-        return True
+        # Медиа без подписи не может пройти фильтр по хэштегам или ключевым словам
+        return not (self.text_required and not text)
 
-    if "video" in filters["filter_message_types"] and isinstance(message.media, types.MessageMediaDocument) and message.media.document.mime_type.startswith('video'):
-        if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
-            print("Сообщение отфильтровано: видео без текста, но есть фильтры по хэштегам или ключевым словам")
+    def should_download(self, message):
+        media = message.media
+        if not media:
             return False
-        return True
 
-    if "document" in filters["filter_message_types"] and isinstance(message.media, types.MessageMediaDocument) and not message.media.document.mime_type.startswith('video'):
-        if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
-            print("Сообщение отфильтровано: документ без текста, но есть фильтры по хэштегам или ключевым словам")
+        text = message.text
+        if not self.matches_text(text):
             return False
-        return True
-
-    if message.media:
-        if isinstance(message.media, types.MessageMediaPhoto):
-            for ext in filters["filter_message_types"]:
-                if ext in ["jpg", "jpeg", "png", "gif"] and ext in message.media.photo.mime_type.lower():
-                    if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
-                        print("Сообщение отфильтровано: фото без текста, но есть фильтры по хэштегам или ключевым словам")
-                        return False
-                    return True
-        elif isinstance(message.media, types.MessageMediaDocument):
-            for ext in filters["filter_message_types"]:
-                if message.media.document.mime_type.startswith('video') and ext in ["mp4", "mov", "avi"]:
-                    if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
-                        print("Сообщение отфильтровано: видео без текста, но есть фильтры по хэштегам или ключевым словам")
-                        return False
-                    return True
-                if not message.media.document.mime_type.startswith('video') and ext in ["pdf", "doc", "docx", "txt"]:
-                    if (filters["filter_hashtags"] or filters["filter_keywords"]) and not message.text:
-                        print("Сообщение отфильтровано: документ без текста, но есть фильтры по хэштегам или ключевым словам")
-                        return False
-                    return True
 
-    return False
+        kind = self.media_kind(media)
+        if not self.enabled:
+            return self.size_ok(media) if isinstance(media, types.MessageMediaDocument) and kind else True
 
+        if not self.accepts_kind(kind):
+            return False
+        if self.text_required and not text:
+            return False
+        if kind != "photo" and not self.size_ok(media):
+            return False
 
-def is_valid_media_extension(media_path, filters):
-    if not media_path:
-        return True
-
-    if not filters["filter_message_types"]:
-        return True
-
-    for ext in filters["filter_message_types"]:
-        if ext in ["jpg", "jpeg", "png", "gif", "mp4", "mov", "avi", "pdf", "doc", "docx", "txt"] and media_path.endswith(ext):
-            return True
-
-    if "photo" in filters["filter_message_types"] and media_path.endswith(("jpg", "jpeg", "png", "gif")):
-        return True
-    if "video" in filters["filter_message_types"] and media_path.endswith(("mp4", "mov", "avi")):
-        return True
-    if "document" in filters["filter_message_types"] and media_path.endswith(("pdf", "doc", "docx", "txt")):
+        file_name, mime_type, size = media_file_info(media)
+        if not classify_media(self.filters["filter_message_types"], file_name, mime_type):
+            self.skipped_media += 1
+            self.saved_bytes += size or 0
+            return False
         return True
 
-    return False
-
 # Главная функция
 async def main():
+    metrics_server = await start_metrics_server() if metrics_port else None
+    try:
+        await parse()
+    finally:
+        if metrics_server:
+            metrics_server.close()
+        if metrics_dump_path:
+            dump_metrics()
+
+async def parse():
     if not await client.is_user_authorized():
-        print("Клиент не авторизован, запускаем процесс авторизации...")
+        logger.info("Клиент не авторизован, запускаем процесс авторизации...")
         await client.start(phone)
     else:
-        print("Клиент уже авторизован.")
+        logger.info("Клиент уже авторизован.")
 
-    storage_provider = MongoDBProvider(mongodb_uri)
-    await storage_provider.load_all_chats()
+    storage_provider = create_storage_provider()
+    await storage_provider.ensure_indexes()
+    dialogs_refreshed = await storage_provider.load_all_chats()
 
     filters = load_filters()
     # print(f"Загруженные фильтры: {filters}")
@@ -445,21 +2439,62 @@ async def main():
     try:
         chat_ids = [int(chat_id) for chat_id in filters["chats"]] if filters["chats"] else await storage_provider.get_active_chats()
     except ValueError as e:
-        print(f"Ошибка при преобразовании chat_id в число: {e}")
+        logger.error("Ошибка при преобразовании chat_id в число: %s", e)
         chat_ids = await storage_provider.get_active_chats()
 
-    print(f"Чаты для парсинга: {chat_ids}")
+    logger.info("Чаты для парсинга: %s", chat_ids)
 
     if not chat_ids:
-        print("Нет чатов для парсинга. Проверьте filters.json или наличие активных чатов в MongoDB.")
+        logger.warning("Нет чатов для парсинга. Проверьте filters.json или наличие активных чатов в MongoDB.")
         return
 
-    for chat_id in chat_ids:
-        print(f"Парсим чат: {chat_id}")
-        await fetch_chat_messages(chat_id, filters)
+    # В разовом запуске без обратной выгрузки чаты без новых сообщений не трогаем. Это можно решить только
+    # по свежим top_message_id: если синхронизация пропущена по DIALOG_SYNC_TTL, выгружаем все чаты
+    if not stream_mode and not backfill_enabled and dialogs_refreshed:
+        updated_chat_ids = await storage_provider.get_chats_with_new_messages(chat_ids)
+        logger.info("Чатов с новыми сообщениями: %s из %s", len(updated_chat_ids), len(chat_ids))
+        chat_ids = updated_chat_ids
 
-    print("Парсинг завершен.")
+    message_filter = MessageFilter(filters)
+    media_downloader = None
+    if download_media_enabled:
+        media_store = MediaStore(download_media_path) if media_store_enabled else None
+        media_downloader = MediaDownloader(storage_provider, message_filter, media_store=media_store)
+        media_downloader.start()
+
+    output_sink = create_output_sink()
+    if output_sink:
+        await output_sink.start()
+
+    try:
+        if shard_worker_id:
+            await run_sharded(chat_ids, message_filter, storage_provider, media_downloader, output_sink)
+        elif stream_mode:
+            await run_stream(chat_ids, message_filter, storage_provider, media_downloader, output_sink)
+        else:
+            scheduler = ChatScheduler(storage_provider, media_downloader=media_downloader, output_sink=output_sink)
+            await scheduler.run(chat_ids, message_filter)
+    finally:
+        if media_downloader:
+            await media_downloader.close()
+        if output_sink:
+            await output_sink.close()
+        storage_provider.close()
+
+    logger.info("Парсинг завершен.")
 
 if __name__ == "__main__":
-    with client:
-        client.loop.run_until_complete(main())
+    setup_logging()
+    if shard_sessions:
+        sys.exit(asyncio.run(run_supervisor()))
+    profiler, profile_file = create_profiler()
+    if profiler:
+        profiler.enable()
+    try:
+        with client:
+            client.loop.run_until_complete(main())
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+            logger.info("Профиль записан в %s", profile_file)
@@ -0,0 +1,220 @@
+import os
+import re
+import sys
+import json
+import base64
+import asyncio
+import argparse
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, TEXT, UpdateOne
+
+# Чтение сохраненных сообщений для потребителей: индексы, запросы с постраничной выдачей и миграция дат.
+# Модуль не зависит от Telethon, поэтому подключается без API_ID/API_HASH
+load_dotenv()
+
+mongodb_uri = os.getenv('MONGODB_URI')
+query_page_size = int(os.getenv('QUERY_PAGE_SIZE', '100'))
+query_max_page_size = int(os.getenv('QUERY_MAX_PAGE_SIZE', '1000'))
+# 'none' — без стемминга и стоп-слов: тикеры и хэштеги ищутся как есть
+text_index_language = os.getenv('TEXT_INDEX_LANGUAGE', 'none')
+migration_batch_size = int(os.getenv('MIGRATION_BATCH_SIZE', '1000'))
+
+# Индексы под запросы MessageQuery; вызывается из MongoDBProvider.ensure_indexes
+async def ensure_query_indexes(messages_collection):
+    # Сообщения чата по времени с однозначным порядком для постраничной выдачи
+    await messages_collection.create_index(
+        [('chat_id', ASCENDING), ('date', DESCENDING), ('id', DESCENDING)],
+        name='chat_id_date_id'
+    )
+    await messages_collection.create_index(
+        [('chat_id', ASCENDING), ('sender_id', ASCENDING), ('date', DESCENDING)],
+        name='chat_id_sender_id_date'
+    )
+    # Отправитель по всем чатам: индекс выше начинается с chat_id и без чата не используется
+    await messages_collection.create_index(
+        [('sender_id', ASCENDING), ('date', DESCENDING), ('chat_id', DESCENDING), ('id', DESCENDING)],
+        name='sender_id_date_chat_id_id'
+    )
+    # Запросы по времени сразу по всем чатам
+    await messages_collection.create_index(
+        [('date', DESCENDING), ('chat_id', DESCENDING), ('id', DESCENDING)],
+        name='date_chat_id_id'
+    )
+    await messages_collection.create_index(
+        [('text', TEXT)],
+        name='text_text',
+        default_language=text_index_language
+    )
+
+# Курсор — последняя выданная позиция (date, chat_id, id), следующая страница начинается строго после нее
+def encode_cursor(document):
+    position = [document['date'].isoformat(), document['chat_id'], document['id']]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        date, chat_id, message_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(date), chat_id, message_id
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Некорректный курсор: {cursor}") from e
+
+class MessageQuery:
+    SORT = [('date', DESCENDING), ('chat_id', DESCENDING), ('id', DESCENDING)]
+
+    def __init__(self, messages_collection, page_size=query_page_size, max_page_size=query_max_page_size):
+        self.messages_collection = messages_collection
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+
+    def build_filter(self, chat_id=None, since=None, until=None, sender_id=None, keyword=None, keyword_mode='auto',
+                     cursor=None):
+        conditions = []
+        if chat_id is not None:
+            conditions.append({'chat_id': chat_id})
+        if sender_id is not None:
+            conditions.append({'sender_id': sender_id})
+        date_range = {}
+        if since is not None:
+            date_range['$gte'] = since
+        if until is not None:
+            date_range['$lt'] = until
+        if date_range:
+            conditions.append({'date': date_range})
+        else:
+            # Строковые даты еще не переведены migrate: по ним нельзя построить курсор, такие документы пропускаем
+            conditions.append({'date': {'$type': 'date'}})
+        if keyword:
+            # $text не сочетается с другими индексами: для чата с ограниченным интервалом дешевле пройти
+            # по индексу chat_id + date и проверить текст регуляркой, иначе ищем по текстовому индексу
+            if keyword_mode == 'auto':
+                keyword_mode = 'regex' if chat_id is not None and since is not None else 'text'
+            if keyword_mode == 'text':
+                conditions.append({'$text': {'$search': keyword}})
+            else:
+                conditions.append({'text': {'$regex': re.escape(keyword), '$options': 'i'}})
+        if cursor:
+            date, last_chat_id, last_id = decode_cursor(cursor)
+            conditions.append({'$or': [
+                {'date': {'$lt': date}},
+                {'date': date, 'chat_id': {'$lt': last_chat_id}},
+                {'date': date, 'chat_id': last_chat_id, 'id': {'$lt': last_id}}
+            ]})
+        if not conditions:
+            return {}
+        return conditions[0] if len(conditions) == 1 else {'$and': conditions}
+
+    async def search(self, chat_id=None, since=None, until=None, sender_id=None, keyword=None, keyword_mode='auto',
+                     limit=None, cursor=None):
+        # Возвращает страницу от новых сообщений к старым и курсор следующей страницы (None, если она последняя)
+        limit = min(limit or self.page_size, self.max_page_size)
+        query = self.build_filter(chat_id, since, until, sender_id, keyword, keyword_mode, cursor)
+        documents = await self.messages_collection.find(query, {'_id': 0}).sort(self.SORT).limit(limit + 1).to_list(limit + 1)
+        next_cursor = encode_cursor(documents[limit - 1]) if len(documents) > limit else None
+        return documents[:limit], next_cursor
+
+    async def iterate(self, **criteria):
+        # Все страницы подряд, для выгрузок
+        cursor = None
+        while True:
+            documents, cursor = await self.search(cursor=cursor, **criteria)
+            for document in documents:
+                yield document
+            if not cursor:
+                return
+
+# Строковые даты от старых версий парсера (str(message.date), например '2025-01-01 12:00:00+00:00')
+def parse_legacy_date(value):
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+async def migrate_string_dates(messages_collection, batch_size=migration_batch_size):
+    converted = failed = 0
+    for field in ('date', 'edit_date'):
+        operations = []
+        async for document in messages_collection.find({field: {'$type': 'string'}}, {field: 1}):
+            date = parse_legacy_date(document[field])
+            if date is None:
+                failed += 1
+                continue
+            # Условие на старое значение: если документ успели переписать, миграция его не тронет
+            operations.append(UpdateOne({'_id': document['_id'], field: document[field]}, {'$set': {field: date}}))
+            if len(operations) >= batch_size:
+                converted += (await messages_collection.bulk_write(operations, ordered=False)).modified_count
+                operations = []
+        if operations:
+            converted += (await messages_collection.bulk_write(operations, ordered=False)).modified_count
+    return converted, failed
+
+def parse_date(value):
+    date = datetime.fromisoformat(value)
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+def parse_duration(value):
+    match = re.fullmatch(r'(\d+)([smhd])', value)
+    if not match:
+        raise argparse.ArgumentTypeError(f"Ожидается длительность вида 30m, 1h, 7d: {value}")
+    unit = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}[match.group(2)]
+    return timedelta(**{unit: int(match.group(1))})
+
+async def run_search(args, messages_collection):
+    since = datetime.now(timezone.utc) - args.last if args.last else args.since
+    documents, next_cursor = await MessageQuery(messages_collection).search(
+        chat_id=args.chat, since=since, until=args.until, sender_id=args.sender, keyword=args.keyword,
+        keyword_mode=args.keyword_mode, limit=args.limit, cursor=args.cursor
+    )
+    for document in documents:
+        print(json.dumps(document, ensure_ascii=False, default=str))
+    if next_cursor:
+        print(f"Следующая страница: --cursor {next_cursor}", file=sys.stderr)
+    if await has_string_dates(messages_collection):
+        print("Есть сообщения со строковыми датами, они не попадают в выдачу: запустите migrate", file=sys.stderr)
+
+async def has_string_dates(messages_collection):
+    return await messages_collection.find_one({'date': {'$type': 'string'}}, {'_id': 1}) is not None
+
+async def run_migrate(args, messages_collection):
+    converted, failed = await migrate_string_dates(messages_collection, args.batch_size)
+    print(f"Преобразовано дат: {converted}, не распознано: {failed}")
+
+async def run_indexes(args, messages_collection):
+    await ensure_query_indexes(messages_collection)
+    print("Индексы созданы")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Запросы к сохраненным сообщениям Telegram")
+    parser.add_argument('--uri', default=mongodb_uri)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    search_parser = subparsers.add_parser('search', help="сообщения по чату, времени, отправителю и ключевому слову")
+    search_parser.add_argument('--chat', type=int)
+    search_parser.add_argument('--sender', type=int)
+    search_parser.add_argument('--since', type=parse_date, help="ISO-дата, без часового пояса считается UTC")
+    search_parser.add_argument('--until', type=parse_date)
+    search_parser.add_argument('--last', type=parse_duration, help="вместо --since: 30m, 1h, 7d")
+    search_parser.add_argument('--keyword')
+    search_parser.add_argument('--keyword-mode', choices=['auto', 'text', 'regex'], default='auto')
+    search_parser.add_argument('--limit', type=int, default=query_page_size)
+    search_parser.add_argument('--cursor')
+    search_parser.set_defaults(handler=run_search)
+
+    migrate_parser = subparsers.add_parser('migrate', help="перевести строковые даты в BSON date")
+    migrate_parser.add_argument('--batch-size', type=int, default=migration_batch_size)
+    migrate_parser.set_defaults(handler=run_migrate)
+
+    indexes_parser = subparsers.add_parser('indexes', help="создать индексы для запросов")
+    indexes_parser.set_defaults(handler=run_indexes)
+
+    args = parser.parse_args()
+    client = AsyncIOMotorClient(args.uri)
+    try:
+        await args.handler(args, client['telegram_db']['messages'])
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())